@@ -0,0 +1,267 @@
+import os, sys
+import json
+
+import utils
+import fileio
+import hashalgo
+
+#
+#  Micro-benchmarks
+#
+#  "python bench.py": for each directory of the file list, the biggest files found by dup.py (so run dup.py
+#  first, at least the lookup) are hashed with each buffer size of fileio.BUFFER_SIZES. The page cache is emptied
+#  before each read when possible (posix_fadvise), to measure the device and not the memory. The best size for
+#  each device is saved in bench_name (see utils.py), and used by the next runs of dup.py.
+#
+#  "python bench.py algo": each hash algo available here (see hashalgo) hashes the same data in memory, to
+#  choose hash_algo in utils.py. The results are saved in bench_name too.
+#
+
+db = utils.db_name
+filelist = utils.filelist_name
+
+# Number of files read for each directory, and max number of bytes read in each file for each buffer size
+
+BENCH_FILES = 3
+BENCH_BYTES = 256 * 1024 * 1024
+
+# A bigger buffer is kept only if it's faster by more than this ratio
+
+BENCH_MARGIN = 1.05
+
+# Data hashed by each algo (in memory), by chunks of BENCH_CHUNK bytes
+
+BENCH_ALGO_BYTES = 256 * 1024 * 1024
+BENCH_CHUNK      = 1024 * 1024
+
+
+#
+#    ====================================================================
+#     Files used for the benchmark
+#    ====================================================================
+#
+
+def bench_files(cnx, path):
+
+    """
+
+        Returns the biggest regular files found in a directory of the file list.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            path (text): The directory (as written in the file list)
+
+        Returns:
+            files (list): Absolute paths of the files
+
+    """
+
+    r = cnx.execute("SELECT dir_path(dir_id), name FROM filelist WHERE file_type = 'f' AND os_errno IS NULL \
+                        AND root_id = (SELECT rid FROM roots WHERE path = ?) ORDER BY size DESC LIMIT ?", (path, BENCH_FILES))
+
+    return [os.path.join(p, name) for p, name in r]
+
+
+def drop_cache(filepath):
+
+    """
+
+        Asks the system to drop the pages of a file from the page cache (only the pages not used by anyone).
+
+        Args:
+            filepath (text): Absolute path of the file
+
+    """
+
+    if hasattr(os, "posix_fadvise"):
+
+        fd = os.open(filepath, os.O_RDONLY)
+
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+#
+#    ====================================================================
+#     Benchmark
+#    ====================================================================
+#
+
+def bench_buffer_sizes(files):
+
+    """
+
+        Hashes the files with each buffer size, and returns the throughput of each size.
+
+        Args:
+            files (list): Absolute paths of the files
+
+        Returns:
+            results (dict): MB/s, by buffer size
+            best (int): The best buffer size (the smallest one, unless a bigger one is really faster)
+
+    """
+
+    results = {}
+
+    for size in fileio.BUFFER_SIZES:
+
+        chrono = utils.Chrono()
+        total = 0
+
+        for filepath in files:
+
+            drop_cache(filepath)
+
+            chrono.start()
+            with fileio.FileReader(filepath, "normal") as f:
+                total = total + f.update(hashalgo.new(utils.hash_algo), size, BENCH_BYTES)
+            chrono.stop()
+
+        results[size] = (total / (1024 * 1024)) / max(chrono.elapsed(total = True), 1e-6)
+
+    best = fileio.BUFFER_SIZES[0]
+
+    for size in fileio.BUFFER_SIZES:
+        if (results[size] > results[best] * BENCH_MARGIN):
+            best = size
+
+    return results, best
+
+
+def bench_hash_algos():
+
+    """
+
+        Hashes the same data in memory with each available hash algo.
+
+        Returns:
+            results (dict): MB/s, by algo name (fastest first)
+
+    """
+
+    data = memoryview(os.urandom(BENCH_CHUNK))
+    results = {}
+
+    for name in hashalgo.available():
+
+        chrono = utils.Chrono()
+        chrono.start()
+
+        hl = hashalgo.new(name)
+        for _ in range(BENCH_ALGO_BYTES // BENCH_CHUNK):
+            hl.update(data)
+        hl.hexdigest()
+
+        chrono.stop()
+
+        results[name] = (BENCH_ALGO_BYTES / (1024 * 1024)) / max(chrono.elapsed(), 1e-6)
+
+    return dict(sorted(results.items(), key = lambda item: -item[1]))
+
+
+def bench_save(section, results):
+
+    """
+
+        Saves the results of a benchmark in bench_name (the other sections are kept).
+
+        Args:
+            section (text): Name of the benchmark
+            results (dict): The results
+
+    """
+
+    try:
+        with open(utils.bench_name) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    saved[section] = results
+
+    with open(utils.bench_name, "w") as f:
+        json.dump(saved, f, indent = 4)
+
+
+
+#
+#    ====================================================================
+#     Main part
+#    ====================================================================
+#
+
+def main():
+
+    arguments = utils.check_arguments(sys.argv)
+
+    # Hash algos (no file access)
+
+    if ("algo" in arguments):
+
+        results = bench_hash_algos()
+
+        for name, v in results.items():
+            print("    {:>12} : {:8.1f} MB/s".format(name, v))
+
+        bench_save("hash_algo", results)
+        print("Results saved in {}. Choose hash_algo in utils.py (a 128 bits or more hash is safer than a checksum).".format(utils.bench_name))
+
+        return
+
+    if not(os.path.exists(db)):
+        print("No database {}: run dup.py first.".format(db))
+        return
+
+    # The throttle and the memory mapping would distort the results
+
+    fileio.throttle.rates = {"bytes": 0, "opens": 0}
+    utils.read_mmap_min_size = 0
+
+    cnx = utils.db_open(db)
+
+    with open(filelist, "r") as f:
+        basepath = f.readlines()
+
+    results = {}
+
+    for line in basepath:
+
+        line = line.rstrip("\n").split(";")
+
+        if (line[0] == ''):
+            continue
+
+        path = line[2]
+        files = bench_files(cnx, path)
+
+        if not(files):
+            print("{}: no file found in the database.".format(path))
+            continue
+
+        mbps, best = bench_buffer_sizes(files)
+
+        print("{} (device {}):".format(path, os.stat(path).st_dev))
+        for size, v in mbps.items():
+            print("    {:>10} : {:8.1f} MB/s{}".format(utils.humanbytes(size), v, "  <= best" if (size == best) else ""))
+
+        results[path] = {"dev": os.stat(path).st_dev, "mbps": mbps, "best": best}
+
+    cnx.close()
+
+    bench_save("buffer_size", results)
+    print("Results saved in {}.".format(utils.bench_name))
+
+    return
+
+
+
+# -------------------------------------------
+#  main call
+# -------------------------------------------
+
+if __name__ == '__main__':
+
+    main()
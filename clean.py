@@ -51,7 +51,7 @@ def exit_handler(signum, frame):
 
 def restart_clean(db):
 
-    cnx = sqlite3.connect(db)
+    cnx = utils.db_open(db)
     cnx.execute("UPDATE filelist SET trashed=NULL, marked_for_deletion=NULL")
     cnx.commit()
     cnx.close()
@@ -70,6 +70,9 @@ def find_for_deletion(db):
             - A master file exists
             - Is not in a directory marked as protected ou master
 
+        Hardlinks (same link_id) are one single file: if one of them is in a master directory, none of them
+        is deleted, otherwise they are all marked (deleting only one of them would not free any space).
+
         Args:
             db (text): Name of the file used for storing sqlite3 database
 
@@ -79,69 +82,25 @@ def find_for_deletion(db):
 
     """
 
-    cnx = sqlite3.connect(db)
-
-    # Selecting files having duplicates
-
-    res = cnx.execute("SELECT * FROM filelist WHERE has_duplicate='1' ORDER BY hash, master DESC, original_path;")
-
-    # Some init
-
-    current_hash = None
-    to_be_deleted = False
-    has_master = False
-
-    # Nb of records read
-    nb_rec = 0
-
-    # Now fetching the DB
-
-    for row in res:
-
-        nb_rec = nb_rec + 1
-
-        # Get info for the file (record)
+    cnx = utils.db_open(db)
 
-        fid, hash, _, path, name, orig_path, _, _, _, _, master, has_dup, _, _, _, _ = row
+    # The hardlinks of a file have the same hash: a group of duplicates (same hash) has a master if one of its
+    # files is in a master directory, and a file (with its links) is kept if one of its links is.
+    # Everything is marked in one statement, with the checkpoint in the same transaction.
 
-        # In case of a new hash, we reset the flags
+    cnx.execute("WITH masters AS (SELECT hash_algo, hash, link_id FROM filelist WHERE has_duplicate = '1' AND master) \
+                    UPDATE filelist SET marked_for_deletion = '1' \
+                    WHERE has_duplicate = '1' AND (hash_algo, hash) IN (SELECT hash_algo, hash FROM masters) \
+                    AND link_id NOT IN (SELECT link_id FROM masters)")
 
-        if current_hash != hash:
-
-            # New hash, reset all flags
-            current_hash = hash 
-            has_master = False
-            to_be_deleted = False
-            #print('-'*50)
-        
-        # We've found a file in a master directory
-
-        if master:
-            has_master = True
-            to_be_deleted = False
-        
-        # If the file (record) has a master, and is not in a protected/master directory, we can delete it
-
-        if has_master and not(master):
-            to_be_deleted = True
-            cnx.execute("UPDATE filelist SET marked_for_deletion = '1' WHERE fid=?", (fid, ))
-
-        # Commit, sometimes
-
-        if (nb_rec % 100) == 0:
-            utils.checkpoint_db(cnx, "mark_for_deletion", current_hash, commit = True)
-
-        #print(nb_rec, fid, hash, master, has_dup, to_be_deleted, path, name, orig_path)
-
-    # Final commit
     utils.checkpoint_db(cnx, "mark_for_deletion", "all", commit = True)
 
     # Nb of marked files
     res = cnx.execute("SELECT count(fid) FROM filelist WHERE marked_for_deletion = '1'")
     nb = res.fetchone()[0]
 
-    # Size of marked files
-    res = cnx.execute("SELECT SUM(size) FROM filelist WHERE marked_for_deletion = '1'")
+    # Size of marked files (the hardlinks of a file are counted once)
+    res = cnx.execute("SELECT SUM(size) FROM filelist WHERE marked_for_deletion = '1' AND fid = link_id")
     size = res.fetchone()[0]
 
     # Ends connection
@@ -169,7 +128,7 @@ def move_files(db):
 
     """
 
-    cnx = sqlite3.connect(db)
+    cnx = utils.db_open(db)
 
     # Nb of marked files
 
@@ -180,14 +139,15 @@ def move_files(db):
 
     # Remaining files to delete
 
-    res = cnx.execute("SELECT count(fid) FROM filelist WHERE (marked_for_deletion = '1') AND (trashed IS NULL);")
+    res = cnx.execute("SELECT count(fid) FROM filelist WHERE (marked_for_deletion = '1') AND (has_duplicate = '1') AND (trashed IS NULL);")
     nb_remaining = res.fetchone()[0]
     str_fmt = FMT_HIGH + "{}" + FMT_RESET + " remaining files to delete/trash."
     print(str_fmt.format(nb_remaining))
 
-    # Selecting files to delete
+    # Selecting files to delete (still having a duplicate: a rescan may have removed the other copies)
 
-    res = cnx.execute("SELECT * FROM filelist WHERE (marked_for_deletion = '1') AND (trashed IS NULL)")
+    res = cnx.execute("SELECT fid, hash, dir_path(dir_id), name, (SELECT path FROM roots WHERE rid = root_id), size, master, has_duplicate, link_id \
+                        FROM filelist WHERE (marked_for_deletion = '1') AND (has_duplicate = '1') AND (trashed IS NULL)")
 
     # Start time
     chrono = utils.Chrono()
@@ -204,7 +164,7 @@ def move_files(db):
 
         nb = nb + 1
 
-        fid, hash, _, path, name, orig_path, size, _, _, _, master, has_dup, _, _, _, _ = row
+        fid, hash, path, name, orig_path, size, master, has_dup, link_id = row
 
         original_file = os.path.join(path, name)
         rel_path = os.path.relpath(path, orig_path)
@@ -217,7 +177,8 @@ def move_files(db):
             # --- shutil.copy2(original_file, copy_file)
             shutil.move(original_file, copy_file)
             nb_trash = nb_trash + 1
-            size_deleted = size_deleted + size
+            if (fid == link_id):
+                size_deleted = size_deleted + size
             cnx.execute("UPDATE filelist SET trashed='1', delete_error=NULL WHERE fid = ?", (fid, ))
 
         except OSError as ose:
@@ -235,10 +196,10 @@ def move_files(db):
             print(FMT_STR_TRASH_PROCESSING.format(nb_trash, nb_fail, perc, chrono.elapsed()), end="\r", flush=True)
             cnx.commit()
             if ((nb % 1000) == 0):
-                utils.checkpoint_db(cnx, "filelist_pre_hash", fid, commit = True)
+                utils.checkpoint_db(cnx, "move_files", fid, commit = True)
 
     # Ends connection
-    cnx.commit()
+    utils.checkpoint_db(cnx, "move_files", "all", commit = True)
     cnx.close()
 
     return nb_trash, nb_fail, size_deleted
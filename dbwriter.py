@@ -0,0 +1,214 @@
+import time
+import queue
+import threading
+import collections
+
+import utils
+
+#
+#  Database writer of the hashing steps
+#
+#  The hashing steps get their results from the workers, and write them in the database. With a commit every
+#  db_batch_size results, the step waits for each commit (and its fsync) before handing new files to the
+#  workers. The writer takes the results (UPDATE statements and their values) and writes them in the
+#  background: the results are grouped by statement (executemany), and committed together when there are
+#  db_batch_size of them, or db_commit_interval seconds after the first one (see utils.py), whichever comes
+#  first. The last checkpoint given comes with them, in the same transaction: it always covers results
+#  already written.
+#
+#  The writer thread has its own connection, which needs the WAL journal (readers and the writer don't block
+#  each other). With another journal (db_profile = "default"), the results are written by the calling thread,
+#  with the same grouping.
+#
+#  The results waiting for the writer thread are bounded (QUEUE_BATCHES batches): beyond, the hashing waits.
+#
+#  Note: a result not committed yet is lost if dup.py is stopped, and simply computed again by the restart.
+#
+
+STOP = None
+
+QUEUE_BATCHES = 4
+QUEUE_WAIT    = 0.01
+
+
+#    -------------------------------
+#
+#     Writer
+#
+#    -------------------------------
+
+class DbWriter:
+
+    """
+        Writes the results of a step in batches, with the checkpoint, in a separate thread (WAL journal) or in
+        the calling thread.
+    """
+
+    def __init__(self, cnx, db = None):
+
+        #
+        # Init function. cnx is the connection of the step, which must not hold a write transaction while the
+        # writer thread is running (so it's committed here).
+        #
+
+        if (db == None):
+            db = utils.db_name
+
+        cnx.commit()
+
+        self.cnx = cnx
+
+        # Pending results ({statement: [values]}), number of results, checkpoint, time of the first result
+
+        self.pending = collections.defaultdict(list)
+        self.nb = 0
+        self.last = None
+        self.t = None
+
+        self.error = None
+        self.thread = None
+
+        journal = cnx.execute("PRAGMA journal_mode").fetchone()[0]
+
+        # A SimpleQueue, because close() can be called by a signal handler (CTRL+C) during a put(): no lock is
+        # involved, so the queue is bounded by waiting (see put)
+
+        if (journal.lower() == "wal"):
+            self.queue = queue.SimpleQueue()
+            self.maxsize = QUEUE_BATCHES * utils.db_batch_size
+            self.thread = threading.Thread(target = self.run, args = (db,), daemon = True)
+            self.thread.start()
+
+
+    def write(self, sql, values):
+
+        # Adds a result: an UPDATE statement and its values
+
+        self.put((sql, values))
+
+
+    def checkpoint(self, last_step, last_id):
+
+        # Sets the checkpoint written with the next commit (it covers the results given so far)
+
+        self.put((STOP, (last_step, last_id)))
+
+
+    def put(self, item):
+
+        if (self.error != None):
+            raise self.error
+
+        if (self.thread != None):
+
+            while (self.queue.qsize() >= self.maxsize) and self.thread.is_alive():
+                time.sleep(QUEUE_WAIT)
+
+            if (self.error != None):
+                raise self.error
+
+            self.queue.put(item)
+
+        else:
+            self.add(item)
+            self.commit_check(self.cnx)
+
+
+    def close(self):
+
+        # Writes and commits everything, and stops the thread
+
+        if (self.thread != None):
+            self.queue.put(STOP)
+            self.thread.join()
+        else:
+            self.commit(self.cnx)
+
+        if (self.error != None):
+            raise self.error
+
+
+    def add(self, item):
+
+        # A result, or a checkpoint
+
+        sql, values = item
+
+        if (sql == STOP):
+            self.last = values
+        else:
+            self.pending[sql].append(values)
+            self.nb = self.nb + 1
+
+        if (self.t == None):
+            self.t = time.monotonic()
+
+
+    def commit_check(self, cnx):
+
+        # Commits if the batch is full, or old enough
+
+        if (self.t != None) and ((self.nb >= utils.db_batch_size) or (time.monotonic() - self.t >= utils.db_commit_interval)):
+            self.commit(cnx)
+
+
+    def commit(self, cnx):
+
+        # Writes the pending results and the checkpoint, in one transaction
+
+        for sql, values in self.pending.items():
+            cnx.executemany(sql, values)
+
+        if (self.last != None):
+            utils.checkpoint_db(cnx, *self.last)
+
+        cnx.commit()
+
+        self.pending.clear()
+        self.nb = 0
+        self.last = None
+        self.t = None
+
+
+    def run(self, db):
+
+        # Writer thread: waits for the results, until the batch is full or old enough
+
+        cnx = utils.db_open(db)
+
+        try:
+
+            while True:
+
+                timeout = None if (self.t == None) else max(0, self.t + utils.db_commit_interval - time.monotonic())
+
+                try:
+                    item = self.queue.get(timeout = timeout)
+                except queue.Empty:
+                    item = False
+
+                if (item == STOP):
+                    break
+
+                if (item):
+                    self.add(item)
+
+                self.commit_check(cnx)
+
+            self.commit(cnx)
+
+        except Exception as e:
+
+            self.error = e
+
+        finally:
+
+            cnx.close()
+
+
+
+#
+# Hey, doc: we're in a module!
+#
+if (__name__ == '__main__'):
+    print('Module => Do not execute')
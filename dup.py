@@ -1,14 +1,28 @@
-import io, os, sys
-import hashlib, binascii
+import io, os, sys, stat
+import struct
 import time
 import sqlite3
 import signal
+import collections
+import itertools
+import concurrent.futures
 
 import utils
+import dbwriter
+import hashcache
+import hashalgo
+import fileio
 
 from colorama import Fore, Back, Style 
 from colorama import init
 
+# Only used to ask the filesystem where the files are on disk (Linux)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 #
 #  Some constants
 #
@@ -16,11 +30,81 @@ from colorama import init
 FMT_STR_CONSIDERING_DIR = "Considering " + Fore.LIGHTGREEN_EX + Style.DIM + "{}" + Fore.RESET + Style.RESET_ALL + " (master:{}, protected:{})..."
 FMT_STR_COMPLETED_DIR = "Completed directory lookup for " + Fore.LIGHTGREEN_EX + Style.DIM + "{}" + Fore.RESET + Style.RESET_ALL 
 
+# File types stored in the 'file_type' column (only regular files are hashed)
+
+FILE_TYPE_REGULAR = "f"
+FILE_TYPE_SYMLINK = "l"
+FILE_TYPE_OTHER   = "o"
+
+# Directories are yielded by the tree walk, but stored in the 'directories' table
+
+FILE_TYPE_DIR     = "d"
+
+# Number of bytes read for the pre-hash. A file no larger than that is entirely covered by its pre-hash.
+
+PRE_HASH_SIZE = io.DEFAULT_BUFFER_SIZE
+
+# Intermediate hash stages (between the pre-hash and the full hash), and the column storing each of them
+
+HASH_STAGES = {
+    "tail":   "tail_hash",
+    "sample": "sample_hash",
+}
+
+# A file is a duplicate candidate only if all its previous steps went well. Hardlinks (same device and inode)
+# are one single file: only the first one (fid = link_id) is hashed, see links_propagate.
+
+CANDIDATE_FILTER = "pre_hash NOT NULL AND os_errno IS NULL AND NOT access_denied AND fid = link_id"
+
+# Last steps of a completed scan (clean.py writes its own steps in the same checkpoint): a rescan can start
+
+SCAN_COMPLETED = ("duplicates_update", "mark_for_deletion", "move_files")
+
+# Order of the files read by the hashing steps (see io_order in utils.py), and the FIEMAP request
+# (Linux ioctl): header (start, length, flags, mapped extents, extent count, reserved) + 1 extent
+
+IO_ORDERS = {
+    "fid":    ["fid"],
+    "inode":  ["dev", "inode", "fid"],
+    "extent": ["dev", "disk_offset", "inode", "fid"],
+}
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQLLLL")
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+
+def hash_kind(stage):
+
+    """
+
+        Returns the kind of a hash, as stored in the hash cache: the name of the stage and the parameters
+        that change its value (if the parameters change, the cached hashes are not used).
+
+        Args:
+            stage (text): "pre", "full", or an intermediate stage (in HASH_STAGES)
+
+        Returns:
+            kind (text): Kind of the hash
+
+    """
+
+    if (stage == "pre"):
+        return "pre:{}".format(PRE_HASH_SIZE)
+    elif (stage == "tail"):
+        return "tail:{}".format(utils.tail_hash_size)
+    elif (stage == "sample"):
+        return "sample:{}x{}".format(utils.sample_count, utils.sample_block_size)
+    else:
+        return stage
+
 
 #
 # 1. Discovering files
-# 2. Calculating quick hash (on the first 8192 bytes only)
-# 3. Calculating complete hash for duplicate candidates
+# 2. Grouping files by size (a file with a unique size has no duplicate)
+# 3. Calculating quick hash (on the first 8192 bytes only)
+# 4. Calculating intermediate hashes (tail, samples...) for big duplicate candidates
+# 5. Calculating complete hash for duplicate candidates
 #
 # REMEMBER : Trust No-One. Filter and sanitize all fields and entries
 #
@@ -36,13 +120,19 @@ filelist = utils.filelist_name
 restart = False
 last_step = None
 last_id = None
+cnx = None
+writer = None
 
 
 def exit_handler(signum, frame):
 
     print()
     print("Normal exit from KeyboardInterrupt (CTRL+C)")
-    utils.checkpoint_db(cnx, last_step, last_id, commit = True)
+    if (writer != None):
+        # The database writer of the step commits its last results with the checkpoint
+        writer.close()
+    elif (cnx != None):
+        utils.checkpoint_db(cnx, last_step, last_id, commit = True)
     exit(0)
 
 #
@@ -67,12 +157,12 @@ def file_hash_calc(filename, algo_name, pre_hash=True):
         Args:
 
             filename (text): Absolute path for the file
-            algo_name(text): Name of the hash algo we use ("md5", "sha1", and even "crc32")
+            algo_name(text): Name of the hash algo we use ("md5", "sha1", "crc32", "xxh64"... see hashalgo)
             pre_hash (boolean): Indicates if we compute a pre-hash or not
 
         Returns:
 
-            h (text): The hash value (hexa text)
+            h (bytes): The hash value
             t (int): execution time (in seconds)
 
         .. Example:: file_hash_calc("test.txt", "md5")
@@ -84,87 +174,279 @@ def file_hash_calc(filename, algo_name, pre_hash=True):
     chrono = utils.Chrono()
     chrono.start()
 
+    # The pre-hash reads are throttled here, the full hash ones by the reader (see fileio)
+
+    if (pre_hash):
+        fileio.throttle.acquire(nbytes = PRE_HASH_SIZE, opens = 1)
+
     #
-    #  ---> Depending on the selected algo, let's calculate the hash
+    #  ---> Whatever the selected algo (hashlib, zlib checksums, xxhash...), the hash object works the same way
+    #       (see hashalgo)
     #
 
-    if (algo_name != "crc32"):
+    hl = hashalgo.new(algo_name)
 
-        # Here we have the 'hashlib' hashes
-        # ---
+    #
+    # We calculate here only the first bytes for the pre_hash (to speed up the calculation and alors to avoid MemoryError with big files)
+    #
+    # For complete hash, we need to split the reading, with the page cache policy set in utils.py (see fileio).
+    # 
 
-        hl = getattr(hashlib, algo_name)()
+    with (open(filename,'rb') if pre_hash else fileio.FileReader(filename)) as f:
 
-        #
-        # We calculate here only the first bytes for the pre_hash (to speed up the calculation and alors to avoid MemoryError with big files)
-        #
-        # For complete hash, we need to split the reading.
-        # 
+        if (pre_hash):
 
-        with open(filename,'rb') as f:
+            #
+            # Pre-hash => Only on the first bytes
+            #
 
-            if (pre_hash):
+            hl.update(f.read(PRE_HASH_SIZE))
 
-                #
-                # Pre-hash => Only on the first bytes
-                #
+        else:
 
-                hl.update(f.read(io.DEFAULT_BUFFER_SIZE))
+            #
+            # Complete hash => split the file
+            #
+            # The reads go to a buffer reused for all the files (read_buffer_size, or the size found by
+            # bench.py for the device), so we don't allocate anything, and the hash is computed on the buffer
+            # itself. The big files can also be mapped in memory (read_mmap_min_size).
+            #
 
-            else:
+            f.update(hl)
 
-                #
-                # Complete hash => split the file
-                #
+    h = hl.digest()
 
-                while True:
+    # End time
 
-                    #
-                    # We use the read only the size of the block to avoid
-                    # heavy ram usage. The file content is buffered.
-                    #
+    chrono.stop()
 
-                    data = f.read(io.DEFAULT_BUFFER_SIZE)
+    # 
+    # ---> We return both hash and execution time (for info)
+    #
 
-                    if not data:
+    return h, chrono.elapsed()
 
-                        # if we don't have any more data to read, stop.
-                        break
 
-                    # we partially calculate the hash
-                    hl.update(data)
 
-        # 
-        # We have exceptions: the 'shake' hashes need one argument
-        # Else, for all other hashes, we don't need any argument adnd we 
-        # can calculate the hash with the hexdigest() method.
-        # 
+#
+#    ====================================================================
+#     Hash of an empty file (no file access)
+#    ====================================================================
+#
 
-        if (algo_name == "shake_128"):
-            h = hl.hexdigest(128)
-        elif (algo_name == "shake_256"):
-            h = hl.hexdigest(256)
-        else:
-            h = hl.hexdigest()
+def empty_hash(algo_name):
 
-    else:
+    """
 
-        # 
-        # Here we have the 'binascii' hashes (CRC32). Included in an other library.
-        # 
+        Returns the hash of an empty content, in the same format as file_hash_calc. All the zero-length files
+        have this hash, we don't need to open them.
 
-        with open(filename,'rb') as f:
-            h = binascii.crc32(f.read(8192))
+        Args:
+            algo_name(text): Name of the hash algo we use
 
-    # End time
+        Returns:
+            h (bytes): The hash value
 
-    chrono.stop()
+    """
 
-    # 
-    # ---> We return both hash and execution time (for info)
-    #
+    return hashalgo.new(algo_name).digest()
 
-    return h, chrono.elapsed()
+
+
+#
+#    ====================================================================
+#     Partial hash calculation (intermediate stages)
+#    ====================================================================
+#
+
+def stage_parts(stage, size):
+
+    """
+
+        Returns the parts of a file read by an intermediate hash stage.
+
+            - "tail": the last tail_hash_size bytes
+            - "sample": sample_count blocks of sample_block_size bytes, evenly spread in the file
+
+        Args:
+            stage (text): Name of the stage (in HASH_STAGES)
+            size (int): Size of the file
+
+        Returns:
+            parts (list): (offset, length) tuples
+
+    """
+
+    if (stage == "tail"):
+
+        length = min(size, utils.tail_hash_size)
+        return [(size - length, length)]
+
+    elif (stage == "sample"):
+
+        count = utils.sample_count
+        return [(size * (i + 1) // (count + 1), utils.sample_block_size) for i in range(count)]
+
+    raise ValueError("Unknown hash stage: {}".format(stage))
+
+
+def file_stage_hash(filename, algo_name, stage, size):
+
+    """
+
+        Returns the hash of some parts of a file, for an intermediate stage between the pre-hash (first bytes)
+        and the full hash. Each stage is more expensive than the previous one, but much cheaper than the
+        full hash for big files: for instance, media files often share their headers but differ at the end.
+
+        Args:
+            filename (text): Absolute path for the file
+            algo_name(text): Name of the hash algo we use
+            stage (text): Name of the stage (in HASH_STAGES)
+            size (int): Size of the file (from the database)
+
+        Returns:
+            h (bytes): The hash value
+
+    """
+
+    parts = stage_parts(stage, size)
+
+    fileio.throttle.acquire(nbytes = sum(length for _, length in parts), opens = 1)
+
+    hl = hashalgo.new(algo_name)
+
+    with open(filename,'rb') as f:
+
+        for offset, length in parts:
+            f.seek(offset)
+            hl.update(f.read(length))
+
+    return hl.digest()
+
+
+
+#
+#    ====================================================================
+#     Tree hash (very big files, hashed by several readers)
+#    ====================================================================
+#
+
+def full_hash_algo(algo_name, size):
+
+    """
+
+        Returns the name of the full hash of a file, recorded with the hash (hash_algo column): the name of the
+        algo, or "<algo>-tree:<segment size>" for the files hashed by segments (see file_tree_hash). The hashes
+        of different kinds are never compared.
+
+        Args:
+            algo_name(text): Name of the hash algo we use
+            size (int): Size of the file
+
+        Returns:
+            name (text): The name of the full hash
+
+    """
+
+    if (utils.tree_hash_min_size > 0) and (size >= utils.tree_hash_min_size):
+        return "{}-tree:{}".format(algo_name, utils.tree_segment_size)
+
+    return algo_name
+
+
+def full_hash_algos(algo_name):
+
+    """
+
+        Returns the kinds of full hash used with an algo, with the SQL condition selecting their files.
+
+        Args:
+            algo_name(text): Name of the hash algo we use
+
+        Returns:
+            (list) of (SQL condition, name of the full hash) tuples
+
+    """
+
+    if (utils.tree_hash_min_size > 0):
+        return [("size < {}".format(utils.tree_hash_min_size), algo_name),
+                ("size >= {}".format(utils.tree_hash_min_size), full_hash_algo(algo_name, utils.tree_hash_min_size))]
+
+    return [("1", algo_name)]
+
+
+def file_tree_hash(filename, algo_name, size):
+
+    """
+
+        Returns the tree hash of a file: the file is split in segments of tree_segment_size bytes, hashed in
+        parallel by tree_workers readers, and the hashes of the segments are combined in a Merkle tree (the
+        hash of each pair of nodes, level by level, until the root). A single huge file then uses several cores
+        and several outstanding reads, instead of one.
+
+        The leaves and the nodes are prefixed (0x00 and 0x01), so a segment can't be mistaken for a node.
+
+        Args:
+            filename (text): Absolute path for the file
+            algo_name(text): Name of the hash algo we use
+            size (int): Size of the file
+
+        Returns:
+            h (bytes): The root hash
+
+    """
+
+    segment = utils.tree_segment_size
+
+    def leaf(i):
+
+        hl = hashalgo.new(algo_name, b"\x00")
+
+        with fileio.FileReader(filename) as f:
+            f.seek(i * segment)
+            f.update(hl, limit = segment)
+
+        return hl.digest()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = utils.tree_workers) as executor:
+        level = list(executor.map(leaf, range(max(1, -(-size // segment)))))
+
+    while (len(level) > 1):
+        level = [hashalgo.new(algo_name, b"\x01" + b"".join(level[i:i + 2])).digest() if (i + 1 < len(level)) else level[i]
+                    for i in range(0, len(level), 2)]
+
+    return level[0]
+
+
+def tree_hash_job(args):
+
+    """
+
+        Tree hash of one file, in a worker (same results as hash_job).
+
+        Args:
+            args (tuple): (fid, filepath, algo name, size)
+
+        Returns:
+            fid (int): the file ID
+            h (text): the hash value, or None in case of error
+            error (tuple): None, or (permission denied flag, errno, strerror)
+
+    """
+
+    fid, filepath, algo_name, size = args
+
+    try:
+
+        return fid, file_tree_hash(filepath, algo_name, size), None
+
+    except PermissionError as pe:
+
+        return fid, None, (True, pe.errno, pe.strerror)
+
+    except OSError as ose:
+
+        return fid, None, (False, ose.errno, ose.strerror)
 
 
 
@@ -191,7 +473,7 @@ def db_connect(db, restart = False):
 
     """
 
-    cnx = sqlite3.connect(db)
+    cnx = utils.db_open(db)
 
     #
     # ---> Did we ask for a restart or not?
@@ -218,21 +500,24 @@ def db_connect(db, restart = False):
 
             else:
 
-                # The script is in progress
-                pass
+                # The script is in progress (maybe with a database of a previous version)
+                db_migrate(cnx)
 
         else:
 
             # No, there's no existing database, so we create one
 
+            cnx.close()
             cnx = db_create(db)
 
     else:
 
         #
         #  'restart' is passed in args. So we drop & recreate the database
+        #  (no other connection must be open, the page size may change)
         #
 
+        cnx.close()
         cnx = db_create(db)
 
     return cnx
@@ -258,7 +543,7 @@ def db_create(db):
             cnx (sqlite3.Connection): Connection object (bound to the file _filename_)
     """
 
-    cnx = sqlite3.connect(db)
+    cnx = utils.db_open(db)
     #cnx = sqlite3.connect(':memory:') ==> in-memory for sqlite3 is not really faster 
     print("Creating database...")
 
@@ -280,17 +565,67 @@ def db_create(db):
 
         print("No old database.")
 
+    for table in ("dirlist", "directories", "roots", "rescan_sizes"):
+        cnx.execute("DROP TABLE IF EXISTS {}".format(table))
+
+    # The database is empty, it's time to set the page size of the performance profile
+
+    utils.db_page_size_check(cnx)
+
+    # ---> The files, the directories and the roots (directories of filelist.txt)
+
+    db_create_tables(cnx)
+
+    # ---> The useful indexes are created after the files lookup (see db_create_indexes)
+
+    #
+    # ---> Params table used to store infomation about the process and restart steps.
+    #
+    
+    cnx.execute("CREATE TABLE params(\
+                    key TINYTEXT,\
+                    value TEXT)\
+                ")
+
+    # --- > Default values
+
+    cnx.execute("INSERT INTO params VALUES ('last_step','')")
+    cnx.execute("INSERT INTO params VALUES ('last_id','')")
+    cnx.execute("INSERT INTO params VALUES ('last_path','')")
+    cnx.execute("INSERT INTO params VALUES ('last_file','')")
+    cnx.execute("INSERT INTO params VALUES ('hash_algo',?)", (utils.hash_algo,))
+
+    cnx.commit()
+
+    return cnx
+
+
+def db_create_tables(cnx):
+
+    """
+
+        Creates the tables of the files, the directories and the roots.
+
+        The layout is normalized to keep the database small: a file refers to its directory and to its root (a
+        directory of filelist.txt) by their IDs, a directory to its parent (the path of a directory is rebuilt
+        by the SQL function dir_path, see utils.DirPaths), and the hashes are stored in binary.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+    """
+
     #
     # ---> Let's create the table used for storing files information
     #
     
     cnx.execute("CREATE TABLE filelist (\
                     fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, \
-                    hash CHAR(256), \
-                    pre_hash CHAR(256), \
-                    path VARCHAR(4096), \
+                    hash BLOB, \
+                    pre_hash BLOB, \
+                    dir_id INTEGER, \
                     name TINYTEXT, \
-                    original_path VARCHAR(4096), \
+                    root_id INTEGER, \
                     size BIGINT, \
                     marked_for_deletion BOOL, \
                     protected BOOL, \
@@ -300,73 +635,338 @@ def db_create(db):
                     os_errno TINYINT, \
                     os_strerror TEXT, \
                     trashed BOOL, \
-                    delete_error TINYINT) \
+                    delete_error TINYINT, \
+                    mtime_ns BIGINT, \
+                    dev BIGINT, \
+                    inode BIGINT, \
+                    file_type CHAR(1), \
+                    size_candidate BOOL, \
+                    tail_hash BLOB, \
+                    sample_hash BLOB, \
+                    link_id INTEGER, \
+                    disk_offset BIGINT, \
+                    hash_algo TINYTEXT) \
                 ")
 
-    # ---> Some useful indexes to speed up the processing
+    # ---> The directories (a root directory has no parent, and its full path as name), with their mtime (used
+    #      by the incremental rescan). 'listed' is set once the files of a directory are stored (see
+    #      directory_lookup).
 
-    cnx.execute("CREATE INDEX index_filepath ON filelist (path, name)")
-    cnx.execute("CREATE INDEX index_hash ON filelist (hash)")
-    cnx.execute("CREATE INDEX index_pre_hash ON filelist (pre_hash)")
-
-    #
-    # ---> Params table used to store infomation about the process and restart steps.
-    #
-    
-    cnx.execute("CREATE TABLE params(\
-                    key TINYTEXT,\
-                    value TEXT)\
+    cnx.execute("CREATE TABLE directories (\
+                    did INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, \
+                    parent_id INTEGER, \
+                    name TINYTEXT, \
+                    root_id INTEGER, \
+                    mtime_ns BIGINT, \
+                    scanned BOOL, \
+                    listed BOOL) \
                 ")
 
-    # --- > Default values
+    # ---> The directories of filelist.txt
 
-    cnx.execute("INSERT INTO params VALUES ('last_step','')")
-    cnx.execute("INSERT INTO params VALUES ('last_id','')")
-    cnx.execute("INSERT INTO params VALUES ('last_path','')")
-    cnx.execute("INSERT INTO params VALUES ('last_file','')")
+    cnx.execute("CREATE TABLE roots (\
+                    rid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, \
+                    path VARCHAR(4096) UNIQUE, \
+                    master BOOL, \
+                    protected BOOL) \
+                ")
 
-    cnx.commit()
+    # ---> The sizes of the files changed by an incremental rescan (their groups must be recomputed). A converted
+    #      database may already have it (see db_migrate).
 
-    return cnx
+    cnx.execute("CREATE TABLE IF NOT EXISTS rescan_sizes (\
+                    size BIGINT PRIMARY KEY) \
+                ")
 
 
 #
 #    ====================================================================
-#     Get state of last call in the params table
+#     Migration from the previous layout
 #    ====================================================================
 #
 
-def get_status(cnx):
+def db_migrate(cnx):
 
     """
 
-        Gets the status of the last process, if it has beend stored, to handle a restart if needed.
+        Converts a database of the previous layout (full paths stored with each file, in 'filelist' and
+        'dirlist', and hashes stored as text) to the current one (see db_create_tables). The fids are kept, so
+        the hash cache, the checkpoints and the steps already done are still valid. Nothing is done if the
+        database already has the current layout.
 
         Args:
             cnx (sqlite3.Connection): Connection object
 
-        Returns:
-            value (text): Name of the last executed process
-
     """
 
-    res = cnx.execute("SELECT value FROM params WHERE key='last_step'").fetchone()
+    old_columns = [row[1] for row in cnx.execute("PRAGMA table_info(filelist)")]
 
-    #
-    # ---> Get last step
-    #
+    if ("path" not in old_columns):
+        return
 
-    if (res != None):
-        if (res[0] == ''):
-            res= None
-        else:
-            res = res[0]
+    print("Converting the database to the current layout...")
 
-    #
-    # ---> Get last ID (fid or hash)
-    # 
+    chrono = utils.Chrono()
+    chrono.start()
 
-    lid = cnx.execute("SELECT value FROM params WHERE key='last_id'").fetchone()
+    cnx.execute("ALTER TABLE filelist RENAME TO filelist_old")
+
+    has_dirlist = cnx.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'dirlist'").fetchone()[0]
+
+    if not(has_dirlist):
+        cnx.execute("CREATE TABLE dirlist (path VARCHAR(4096), parent VARCHAR(4096), original_path VARCHAR(4096), mtime_ns BIGINT, scanned BOOL)")
+
+    db_create_tables(cnx)
+
+    # ---> Roots (the flags are the ones of their files)
+
+    cnx.execute("INSERT INTO roots(path, master, protected) \
+                    SELECT original_path, MAX(master), MAX(protected) FROM filelist_old GROUP BY original_path ORDER BY MIN(fid)")
+    cnx.execute("INSERT OR IGNORE INTO roots(path) SELECT DISTINCT original_path FROM dirlist")
+
+    # ---> Directories: the parents first (shorter paths). A directory whose parent is unknown is stored with
+    #      its full path, like a root.
+
+    cnx.execute("CREATE TEMP TABLE migrate_dirs (path VARCHAR(4096) PRIMARY KEY, did INTEGER)")
+
+    dids = {}
+    rows = []
+
+    r = cnx.execute("SELECT d.path, d.parent, r.rid, d.mtime_ns, d.scanned FROM dirlist d LEFT JOIN roots r ON r.path = d.original_path \
+                        UNION ALL SELECT DISTINCT f.path, NULL, r.rid, NULL, NULL FROM filelist_old f LEFT JOIN roots r ON r.path = f.original_path \
+                        WHERE f.path NOT IN (SELECT path FROM dirlist)")
+
+    entries = {}
+
+    for path, parent, rid, mtime_ns, scanned in r:
+        entries.setdefault(path, [parent, rid, mtime_ns, scanned])
+
+    # Without 'dirlist' (first layout), the parent of a directory is the one containing it, up to its root (the
+    # missing ones are added, without mtime: the rescan lists them again)
+
+    roots = dict(cnx.execute("SELECT rid, path FROM roots"))
+
+    for child in list(entries):
+
+        parent, rid = entries[child][:2]
+        root = roots.get(rid)
+
+        while (parent == None) and (root != None) and child.startswith(os.path.join(root, "")):
+
+            parent = os.path.dirname(child)
+            entries[child][0] = parent
+
+            if (parent not in entries):
+                entries[parent] = [None, rid, None, None]
+
+            child = parent
+            parent = entries[child][0]
+
+    for path in sorted(entries, key = len):
+
+        parent, rid, mtime_ns, scanned = entries[path]
+
+        dids[path] = len(dids) + 1
+
+        if (parent in dids):
+            rows.append((dids[path], dids[parent], os.path.basename(path), rid, mtime_ns, scanned))
+        else:
+            rows.append((dids[path], None, path, rid, mtime_ns, scanned))
+
+    cnx.executemany("INSERT INTO directories(did, parent_id, name, root_id, mtime_ns, scanned) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    cnx.executemany("INSERT INTO migrate_dirs VALUES (?, ?)", dids.items())
+
+    # The directories of the completed roots are listed. The other ones will be listed again (see directory_queue).
+
+    cnx.execute("UPDATE directories SET listed = True WHERE root_id IN \
+                    (SELECT rid FROM roots WHERE path IN (SELECT value FROM params WHERE key = 'completed_dir'))")
+
+    rows.clear()
+    dids.clear()
+    entries.clear()
+
+    # ---> Files: same fids, the hashes in binary
+
+    columns = [row[1] for row in cnx.execute("PRAGMA table_info(filelist)") if (row[1] in old_columns)]
+    values = ["digest_blob(f.{0})".format(c) if (c in ("pre_hash", "tail_hash", "sample_hash", "hash")) else "f." + c for c in columns]
+
+    cnx.execute("INSERT INTO filelist({}, dir_id, root_id) SELECT {}, d.did, r.rid FROM filelist_old f \
+                    LEFT JOIN migrate_dirs d ON d.path = f.path LEFT JOIN roots r ON r.path = f.original_path"
+                    .format(", ".join(columns), ", ".join(values)))
+
+    # ---> Columns unknown to the previous layouts. The first one had no metadata (only the size of the files
+    #      already pre-hashed): they are read now, like the lookup does.
+
+    if ("file_type" not in old_columns):
+        migrate_meta(cnx)
+
+    # The hardlinks (each file is its own one if the inodes are not known)
+
+    if ("link_id" not in old_columns):
+        links_identify(cnx, "fid NOT NULL")
+
+    # The algo of the full hashes (the one of the database). Before it, the pre-hash was computed on all the
+    # files: the files no larger than the pre-hash window already have their full hash (see filelist_pre_hash).
+
+    if ("hash_algo" not in old_columns):
+        cnx.execute("UPDATE filelist SET hash = pre_hash WHERE hash IS NULL AND pre_hash NOT NULL AND size <= ? \
+                        AND os_errno IS NULL AND NOT access_denied", (PRE_HASH_SIZE,))
+        cnx.execute("UPDATE filelist SET hash_algo = COALESCE((SELECT value FROM params WHERE key = 'hash_algo'), 'md5') WHERE hash NOT NULL")
+
+    # Before the size grouping, the pre-hash was the step after the lookup: an interrupted pre-hash restarts from
+    # the size grouping (the pre-hashes already computed are kept)
+
+    step, step_id = get_status(cnx)
+
+    if ("size_candidate" not in old_columns) and (step == "filelist_pre_hash") and (step_id != "all"):
+        utils.checkpoint_db(cnx, "directory_lookup", "all")
+
+    cnx.execute("DROP TABLE filelist_old")
+    cnx.execute("DROP TABLE dirlist")
+    cnx.execute("DROP TABLE migrate_dirs")
+
+    # The indexes have been dropped with the old tables
+
+    db_create_indexes(cnx)
+    cnx.execute("VACUUM")
+
+    chrono.stop()
+    print("Database converted in {:.2f} sec.".format(chrono.elapsed()))
+
+
+
+def migrate_meta(cnx):
+
+    """
+
+        Reads the metadata of the files of a converted database which doesn't have them (size, mtime, device,
+        inode and file type, see directory_lookup), by batches of db_batch_size files. A file that can't be read
+        any more gets its error, like in the lookup.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+    """
+
+    fid = 0
+
+    while True:
+
+        r = cnx.execute("SELECT fid, dir_path(dir_id), name FROM filelist WHERE fid > ? AND file_type IS NULL AND os_errno IS NULL \
+                            ORDER BY fid LIMIT ?", (fid, utils.db_batch_size)).fetchall()
+
+        if not(r):
+            break
+
+        rows = []
+        rows_error = []
+
+        for fid, path, name in r:
+
+            try:
+                st = os.stat(os.path.join(path, name), follow_symlinks = False)
+                rows.append(file_meta(st, stat_file_type(st)) + (fid,))
+            except OSError as ose:
+                rows_error.append((isinstance(ose, PermissionError), ose.errno, ose.strerror, fid))
+
+        cnx.executemany("UPDATE filelist SET size = ?, mtime_ns = ?, dev = ?, inode = ?, file_type = ? WHERE fid = ?", rows)
+        cnx.executemany("UPDATE filelist SET access_denied = ?, os_errno = ?, os_strerror = ? WHERE fid = ?", rows_error)
+
+
+
+#
+#    ====================================================================
+#     Secondary indexes (built once, after the bulk load)
+#    ====================================================================
+#
+
+INDEXES = {
+    "index_filepath": "filelist (dir_id, name)",
+    "index_hash":     "filelist (hash)",
+    "index_size_pre_hash": "filelist (size, pre_hash)",
+    "index_inode": "filelist (dev, inode)",
+    "index_directories_parent": "directories (parent_id, name)",
+}
+
+
+def db_create_indexes(cnx):
+
+    """
+
+        Creates the useful indexes to speed up the processing, if they don't exist yet. Building an index once
+        on a loaded table is much quicker than maintaining it on every insert, so this is done at the end of
+        the files lookup.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+    """
+
+    for name, columns in INDEXES.items():
+        cnx.execute("CREATE INDEX IF NOT EXISTS {} ON {}".format(name, columns))
+
+    cnx.commit()
+
+
+def db_drop_indexes(cnx):
+
+    """
+
+        Drops the secondary indexes before a bulk load (files lookup). They are rebuilt by db_create_indexes.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+    """
+
+    for name in INDEXES:
+        cnx.execute("DROP INDEX IF EXISTS {}".format(name))
+
+    # Replaced by index_size_pre_hash (for databases created by an older version)
+
+    cnx.execute("DROP INDEX IF EXISTS index_pre_hash")
+
+    cnx.commit()
+
+
+
+#
+#    ====================================================================
+#     Get state of last call in the params table
+#    ====================================================================
+#
+
+def get_status(cnx):
+
+    """
+
+        Gets the status of the last process, if it has beend stored, to handle a restart if needed.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+        Returns:
+            value (text): Name of the last executed process
+
+    """
+
+    res = cnx.execute("SELECT value FROM params WHERE key='last_step'").fetchone()
+
+    #
+    # ---> Get last step
+    #
+
+    if (res != None):
+        if (res[0] == ''):
+            res= None
+        else:
+            res = res[0]
+
+    #
+    # ---> Get last ID (fid or hash)
+    # 
+
+    lid = cnx.execute("SELECT value FROM params WHERE key='last_id'").fetchone()
 
     if (lid != None):
 
@@ -378,309 +978,2146 @@ def get_status(cnx):
     return res, lid
 
 
-#
-#    ====================================================================
-#     Set state of last (=current) step executed in the params table
-#    ====================================================================
-#
+#
+#    ====================================================================
+#     Set state of last (=current) step executed in the params table
+#    ====================================================================
+#
+
+def checkpoint_db(cnx, last_step, last_id = None, commit = False):
+
+    """
+
+        Sets the status of the current process by storing the name of the last well-executed step.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            last_step (text): Name of the last well-executed step
+
+        Returns:
+            nothing
+
+    """
+
+    cnx.execute("UPDATE params SET value=? WHERE key='last_step'", (last_step,))
+    cnx.execute("UPDATE params SET value=? WHERE key='last_id'", (last_id,))
+
+    if (commit):
+        cnx.commit()
+
+    return 
+
+
+
+#
+#    ====================================================================
+#     Directory calculation (for all files in many directories)
+#    ====================================================================
+#
+
+def directories_lookup(cnx, basepath_list):
+
+    """
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            basepath (text): Array of file paths we will look into.
+
+        Returns:
+            t (time): The execution time of this function
+            nb_to_process (int): The number of files we have to process   
+
+    """
+                
+    t_elaps = 0.0
+
+    # We look for the directories already looked up
+
+    completed_dir = []
+
+    res = cnx.execute("SELECT ALL value FROM params WHERE key = 'completed_dir'")
+
+    for dir_name in res:
+        completed_dir.append(dir_name[0])
+        print(FMT_STR_COMPLETED_DIR.format(dir_name[0]))
+
+    # Bulk load: no secondary index to maintain during the inserts
+
+    db_drop_indexes(cnx)
+
+    # The directories to look up. If a directory has been completed, we skip it. Else, its lookup starts, or
+    # resumes where it stopped (see directory_queue).
+
+    todo = []
+
+    for basepath in basepath_list:
+
+        line        = basepath.rstrip("\n").split(";")
+
+        if line[0] != '':
+
+            p_master, p_protected, path = line
+
+            if (path not in completed_dir):
+                todo.append((p_master, p_protected, path))
+
+    # The files can be hashed while they are discovered (see Pipeline)
+
+    pipeline = Pipeline(cnx, algo) if (utils.pipeline) else None
+
+    # Loop over directories
+
+    for p_master, p_protected, path in todo:
+
+        print(FMT_STR_CONSIDERING_DIR.format(path, bool(int(p_master)), bool(int(p_protected))))
+        t = directory_lookup(cnx, path, p_master, p_protected, pipeline)
+        
+        t_elaps += t
+
+    if (pipeline != None):
+
+        chrono = utils.Chrono()
+        chrono.start()
+
+        pipeline.drain()
+
+        chrono.stop()
+        t_elaps += chrono.elapsed()
+
+        print("Hashed during the lookup: {} pre-hashes, {} stage hashes, {} full hashes ({} from the hash cache).       "
+                .format(pipeline.counts["pre"], pipeline.counts["stage"], pipeline.counts["full"], pipeline.counts["cache"]))
+
+    # All directories are completed, the indexes are built once for all
+
+    chrono = utils.Chrono()
+    chrono.start()
+
+    db_create_indexes(cnx)
+
+    chrono.stop()
+    t_elaps += chrono.elapsed()
+
+    utils.checkpoint_db(cnx, "directory_lookup", "all", commit = True)
+
+    # Returning nb of files to process in the table. Should be the same as nb...
+
+    r = cnx.execute("SELECT COUNT(*) FROM filelist")
+    nb_to_process = r.fetchone()[0]
+
+    return t_elaps, nb_to_process
+
+
+#
+#    ====================================================================
+#     Directory tree walk (scandir-based)
+#    ====================================================================
+#
+
+def scandir_walk(basepath, skip_dir = None):
+
+    """
+
+        Walks (hierarchically) through a folder structure, like os.walk does, but yields the files
+        one by one with their os.DirEntry and the stat information we need for the next steps.
+
+        The stat is taken from the DirEntry cache: on Windows it comes for free with the directory
+        listing, on other systems it costs one lstat() here, and then never again in the later steps.
+        Symbolic links are not followed (neither for directories nor for files), exactly as os.walk
+        does by default. Unreadable directories are silently skipped (like os.walk).
+
+        Each directory is yielded before its files, as (path, parent path, stat, FILE_TYPE_DIR).
+
+        The skip_dir function (if any) is called with (path, parent path, stat) for each directory before listing it.
+        If it returns a list of subdirectories, the directory is not listed (nor yielded) and only these
+        subdirectories are walked. That's how the incremental rescan skips the unchanged directories.
+
+        Args:
+            basepath (text): Directory we look into
+            skip_dir (function): (Optional) Called before listing a directory
+
+        Returns:
+            (generator) of (root, entry, stat, file_type) tuples. stat is an os.stat_result, or the
+            OSError we got when trying to get it (file_type is then None).
+
+    """
+
+    try:
+        dirs = [(basepath, None, os.stat(basepath))]
+    except OSError:
+        return
+
+    while dirs:
+
+        root, parent, root_st = dirs.pop()
+
+        subdirs = []
+
+        # Known and unchanged directory?
+
+        known_subdirs = skip_dir(root, parent, root_st) if skip_dir else None
+
+        if (known_subdirs != None):
+
+            for path in known_subdirs:
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs.append((path, root, st))
+
+            dirs.extend(reversed(subdirs))
+            continue
+
+        try:
+            it = os.scandir(root)
+        except OSError:
+            # Same behaviour as os.walk: unreadable directories are silently skipped
+            continue
+
+        yield root, parent, root_st, FILE_TYPE_DIR
+
+        for entry, st, file_type in directory_entries(it):
+
+            if (file_type == FILE_TYPE_DIR):
+                subdirs.append((entry.path, root, st))
+            else:
+                yield root, entry, st, file_type
+
+        # Top-down order, like os.walk (the stack is LIFO, so we push in reverse order)
+
+        dirs.extend(reversed(subdirs))
+
+
+def directory_entries(it):
+
+    """
+
+        Lists one directory, with the stat information we need (see scandir_walk). Like os.walk, symlinks to
+        directories are considered as directories but not walked into: they are not returned.
+
+        Args:
+            it (iterator): The os.scandir iterator of the directory (closed at the end)
+
+        Returns:
+            (generator) of (entry, stat, file_type) tuples. file_type is FILE_TYPE_DIR for the subdirectories.
+            stat is an os.stat_result, or the OSError we got when trying to get it (file_type is then None).
+
+    """
+
+    with it:
+
+        for entry in it:
+
+            try:
+
+                if entry.is_dir():
+
+                    if not entry.is_symlink():
+                        yield entry, entry.stat(follow_symlinks=False), FILE_TYPE_DIR
+                    continue
+
+                st = entry.stat(follow_symlinks=False)
+
+            except OSError as ose:
+
+                yield entry, ose, None
+                continue
+
+            yield entry, st, stat_file_type(st)
+
+
+def stat_file_type(st):
+
+    """
+
+        Returns the file type we store in the database ('file_type' column), from a stat result.
+
+        Args:
+            st (os.stat_result): The stat of the file (not following symlinks)
+
+        Returns:
+            file_type (text): FILE_TYPE_REGULAR, FILE_TYPE_SYMLINK or FILE_TYPE_OTHER
+
+    """
+
+    if stat.S_ISREG(st.st_mode):
+        return FILE_TYPE_REGULAR
+    elif stat.S_ISLNK(st.st_mode):
+        return FILE_TYPE_SYMLINK
+    else:
+        return FILE_TYPE_OTHER
+
+
+#
+#    ====================================================================
+#     Directory calculation (for all files in one directory)
+#    ====================================================================
+#
+
+def directory_lookup(cnx, basepath, master, protected, pipeline = None, step = "directory_lookup"):
+
+    """
+
+        Looks (hierarchically) for all files within the folder structure, and stores the path and the 
+        name of each file, with the metadata we get from the directory listing (size, mtime, device,
+        inode and file type). The content of the files is not read (to save time).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            basepath (text): Array of file paths we will look into.
+            master (text): "1" if the directory is a master one
+            protected (text): "1" if the directory is protected
+            pipeline (Pipeline): (Optional) Hashes the files while they are discovered, fed after each batch
+            step (text): (Optional) The step in progress ("directory_rescan" for a new directory found by the rescan)
+
+        Returns:
+            t (time): The execution time of this function
+
+    """
+
+    global last_step, last_id
+
+    # Start time
+    chrono = utils.Chrono()
+    chrono.start()
+
+    # Nb of files init
+    nb = 0
+
+    rid = root_id(cnx, basepath, master, protected)
+
+    # Filepath init
+
+    if (basepath == ""):
+        basepath = "."
+
+    #
+    # ---> The directories to list are a work queue: 'directories' rows not listed yet (listed IS NULL). A
+    #      directory is marked as listed in the transaction that stores its files and inserts its subdirectories
+    #      (to be listed), so an interrupted lookup resumes exactly where it stopped: only the directories not
+    #      listed are listed again (what has been stored for them is deleted first).
+    #
+
+    queue = directory_queue(cnx, basepath, rid)
+
+    # Rows are buffered and inserted in batches
+
+    rows = []
+    rows_error = []
+
+    while queue:
+
+        did, dirpath = queue.pop()
+
+        try:
+            it = os.scandir(dirpath)
+        except OSError:
+            # Same behaviour as os.walk: unreadable directories are silently skipped
+            cnx.execute("DELETE FROM directories WHERE did = ?", (did,))
+            continue
+
+        subdirs = []
+
+        for entry, st, file_type in directory_entries(it):
+
+            if (file_type == FILE_TYPE_DIR):
+
+                # A subdirectory, to be listed
+
+                subdirs.append((directory_insert(cnx, entry.path, did, rid, st.st_mtime_ns), entry.path))
+                continue
+
+            # Hey, we got one (file)!
+
+            nb = nb + 1
+
+            if (file_type != None):
+
+                rows.append((did, entry.name, False, rid, master, protected, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, file_type))
+
+            else:
+
+                # No stat for this one (st is the OSError)
+
+                rows_error.append((did, entry.name, isinstance(st, PermissionError), rid, master, protected, st.errno, st.strerror))
+
+            # Checkpoint
+
+            last_step = step
+            last_id = "in progress"
+
+            # Displaying progression and writing (occasionnaly)
+
+            if ((nb % 100) == 0):
+                print("Discovering #{} files ({:.2f} sec)".format(nb, chrono.elapsed()), end="\r", flush=True)
+
+            if ((nb % utils.db_batch_size) == 0):
+                directory_lookup_write(cnx, rows, rows_error)
+                if (pipeline != None):
+                    pipeline.feed()
+                cnx.commit()
+
+        # Listed: committed with its last files. Top-down order, like os.walk (the queue is LIFO)
+
+        cnx.execute("UPDATE directories SET listed = True WHERE did = ?", (did,))
+        queue.extend(reversed(subdirs))
+
+    #
+    # ---> Last commit
+    #
+
+    directory_lookup_write(cnx, rows, rows_error)
+    if (pipeline != None):
+        pipeline.feed()
+    utils.checkpoint_db(cnx, "directory_lookup", basepath)
+
+    # Called by the rescan: the directory is completed, but the rescan goes on (restarted as a rescan)
+
+    if (step != "directory_lookup"):
+        utils.checkpoint_db(cnx, step, "in progress")
+
+    cnx.commit()
+
+    # End time
+    chrono.stop()
+
+    return chrono.elapsed()
+
+
+
+def directory_queue(cnx, basepath, rid):
+
+    """
+
+        Returns the directories of a root still to be listed (the root itself if its lookup never started). The
+        files and subdirectories stored for a directory whose listing was interrupted are deleted: it will be
+        listed again.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            basepath (text): The root directory
+            rid (int): ID of the root
+
+        Returns:
+            queue (list): (did, path) of the directories to list, the first one to list at the end
+
+    """
+
+    known = cnx.execute("SELECT COUNT(*) FROM directories WHERE root_id = ?", (rid,)).fetchone()[0]
+
+    if not(known):
+
+        try:
+            st = os.stat(basepath)
+        except OSError:
+            return []
+
+        return [(directory_insert(cnx, basepath, None, rid, st.st_mtime_ns), basepath)]
+
+    # The master/protected flags may have changed in filelist.txt since the files were stored
+
+    cnx.execute("UPDATE filelist SET (master, protected) = (SELECT master, protected FROM roots WHERE rid = ?) WHERE root_id = ?", (rid, rid))
+
+    pending = "SELECT did FROM directories WHERE root_id = ? AND listed IS NULL"
+
+    cnx.execute("DELETE FROM filelist WHERE dir_id IN ({})".format(pending), (rid,))
+    cnx.execute("DELETE FROM directories WHERE parent_id IN ({})".format(pending), (rid,))
+
+    # Directories stored without their parent (databases converted from an old version) are found again from the root
+
+    cnx.execute("DELETE FROM directories WHERE root_id = ? AND listed IS NULL AND parent_id IS NULL AND name != ?", (rid, basepath))
+    cnx.commit()
+
+    return [(did, dir_path) for did, dir_path in cnx.execute("SELECT did, dir_path(did) FROM directories \
+                WHERE root_id = ? AND listed IS NULL ORDER BY did DESC", (rid,))]
+
+
+def directory_lookup_write(cnx, rows, rows_error):
+
+    """
+
+        Inserts a batch of discovered files. The lists are emptied.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            rows (list): Files with their metadata
+            rows_error (list): Files we couldn't stat, with the error
+
+    """
+
+    cnx.executemany("INSERT INTO filelist(dir_id, name, access_denied, root_id, master, protected, size, mtime_ns, dev, inode, file_type)\
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    cnx.executemany("INSERT INTO filelist(dir_id, name, access_denied, root_id, master, protected, os_errno, os_strerror)\
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows_error)
+
+    rows.clear()
+    rows_error.clear()
+
+
+def directory_insert(cnx, path, parent_id, rid, mtime_ns, scanned = None, listed = None):
+
+    """
+
+        Inserts a directory, and returns its ID.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            path (text): Path of the directory
+            parent_id (int): ID of the parent directory (None for a root)
+            rid (int): ID of the root
+            mtime_ns (int): Modification time of the directory
+            scanned (bool): (Optional) Seen by the current rescan
+            listed (bool): (Optional) Its files are stored (None: still to be listed by the lookup)
+
+        Returns:
+            did (int): ID of the directory
+
+    """
+
+    # A root directory is stored with its full path
+
+    name = os.path.basename(path) if (parent_id != None) else path
+
+    r = cnx.execute("INSERT INTO directories(parent_id, name, root_id, mtime_ns, scanned, listed) VALUES (?, ?, ?, ?, ?, ?)",
+                        (parent_id, name, rid, mtime_ns, scanned, listed))
+
+    return r.lastrowid
+
+
+def root_id(cnx, path, master, protected):
+
+    """
+
+        Returns the ID of a root (a directory of filelist.txt), created if needed. Its flags are updated (they
+        may have changed in filelist.txt).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            path (text): The directory, as written in filelist.txt
+            master (text): "1" if the directory is a master one
+            protected (text): "1" if the directory is protected
+
+        Returns:
+            rid (int): ID of the root
+
+    """
+
+    cnx.execute("INSERT OR IGNORE INTO roots(path) VALUES (?)", (path,))
+    cnx.execute("UPDATE roots SET master = ?, protected = ? WHERE path = ?", (master, protected, path))
+
+    return cnx.execute("SELECT rid FROM roots WHERE path = ?", (path,)).fetchone()[0]
+
+
+
+#
+#    ====================================================================
+#     Incremental rescan (for all directories)
+#    ====================================================================
+#
+
+def directories_rescan(cnx, basepath_list):
+
+    """
+
+        Refreshes a completed scan instead of starting from scratch: the current trees are compared with the
+        files stored in the database. New files are inserted, vanished files are deleted, and the hashes are
+        invalidated for the changed files only. The sizes of all these files are stored in 'rescan_sizes':
+        the next steps only recompute the groups of these sizes.
+
+        A directory whose mtime didn't change since the last scan has the same entries, so it's not listed
+        again (see directory_rescan). A directory listed in filelist.txt but never scanned is looked up as usual.
+
+        The rescan can be interrupted and started again: each directory is synchronized in one transaction.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            basepath_list (text): Array of file paths we will look into.
+
+        Returns:
+            t (time): The execution time of this function
+            nb (tuple): The number of new, changed and deleted files
+
+    """
+
+    global last_step, last_id
+
+    t_elaps = 0.0
+    nb = (0, 0, 0)
+
+    last_step = "directory_rescan"
+    last_id = "in progress"
+
+    utils.checkpoint_db(cnx, "directory_rescan", "in progress", commit = True)
+
+    completed_dir = [row[0] for row in cnx.execute("SELECT ALL value FROM params WHERE key = 'completed_dir'")]
+
+    # Loop over directories
+
+    for basepath in basepath_list:
+
+        line        = basepath.rstrip("\n").split(";")
+
+        if line[0] != '':
+
+            p_master, p_protected, path = line
+
+            print(FMT_STR_CONSIDERING_DIR.format(path, bool(int(p_master)), bool(int(p_protected))))
+
+            # The master/protected flags may have changed in filelist.txt
+
+            rid = root_id(cnx, path, p_master, p_protected)
+
+            if (path in completed_dir):
+
+                cnx.execute("UPDATE filelist SET master = ?, protected = ? WHERE root_id = ?", (p_master, p_protected, rid))
+
+                t, nb_dir = directory_rescan(cnx, path, p_master, p_protected)
+                nb = tuple(a + b for a, b in zip(nb, nb_dir))
+
+            else:
+
+                # A new directory (or a lookup that didn't complete, resumed): all its sizes are affected
+
+                t = directory_lookup(cnx, path, p_master, p_protected, step = "directory_rescan")
+
+                cnx.execute("INSERT OR IGNORE INTO rescan_sizes SELECT DISTINCT size FROM filelist WHERE root_id = ? AND size NOT NULL", (rid,))
+                nb_new = cnx.execute("SELECT COUNT(*) FROM filelist WHERE root_id = ?", (rid,)).fetchone()[0]
+                nb = (nb[0] + nb_new, nb[1], nb[2])
+
+            t_elaps += t
+
+    # The groups are recomputed from the size grouping step
+
+    last_step = "directory_lookup"
+    last_id = "all"
+
+    utils.checkpoint_db(cnx, "directory_lookup", "all", commit = True)
+
+    return t_elaps, nb
+
+
+#
+#    ====================================================================
+#     Incremental rescan (for all files in one directory)
+#    ====================================================================
+#
+
+def directory_rescan(cnx, basepath, master, protected):
+
+    """
+
+        Compares the folder structure with what's stored in the database, and synchronizes the database.
+
+        A directory gets a new mtime each time an entry is created, deleted or renamed in it, so if its mtime
+        didn't change, we don't list it again: its known subdirectories are walked, and its files are only
+        checked with a stat (to detect the files modified in place). With rescan_trust_dir_mtime (utils.py),
+        even this stat is skipped: much quicker, but a file modified in place (same name) is not seen.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            basepath (text): The directory we look into
+            master (text): "1" if the directory is a master one
+            protected (text): "1" if the directory is protected
+
+        Returns:
+            t (time): The execution time of this function
+            nb (tuple): The number of new, changed and deleted files
+
+    """
+
+    # Start time
+    chrono = utils.Chrono()
+    chrono.start()
+
+    counts = [0, 0, 0]
+
+    rid = root_id(cnx, basepath, master, protected)
+
+    # Directories not seen at the end of the walk have vanished
+
+    cnx.execute("UPDATE directories SET scanned = NULL WHERE root_id = ?", (rid,))
+
+    # IDs of the directories of the walk, by path (None for a new directory)
+
+    dids = {}
+
+    def dir_id(dirpath, parent):
+
+        # ID of a known directory, found by its parent and its name (a root has no parent, and its full path as name)
+
+        if (dirpath not in dids):
+
+            if (parent == None):
+                row = cnx.execute("SELECT did FROM directories WHERE parent_id IS NULL AND root_id = ? AND name = ?", (rid, dirpath)).fetchone()
+            elif (dids.get(parent) != None):
+                row = cnx.execute("SELECT did FROM directories WHERE parent_id = ? AND name = ?", (dids[parent], os.path.basename(dirpath))).fetchone()
+            else:
+                row = None
+
+            dids[dirpath] = row[0] if (row != None) else None
+
+        return dids[dirpath]
+
+    def sync_files(did, dirpath, entries):
+
+        # Compares the stored files of a directory with its current ones ({name: (stat or OSError, file_type)})
+        # If entries is None, the directory is not listed: we only check the stored files.
+
+        stored = cnx.execute("SELECT fid, name, size, mtime_ns, dev, inode, file_type FROM filelist WHERE dir_id = ?", (did,)).fetchall()
+
+        for fid, name, size, mtime_ns, dev, inode, file_type in stored:
+
+            if (entries == None):
+
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                    current = (st, stat_file_type(st))
+                except FileNotFoundError:
+                    current = None
+                except OSError as ose:
+                    current = (ose, None)
+
+            else:
+
+                current = entries.pop(name, None)
+
+            if (current == None):
+
+                # Vanished
+
+                cnx.execute("DELETE FROM filelist WHERE fid = ?", (fid,))
+                rescan_sizes_add(cnx, size)
+                counts[2] += 1
+
+            elif (file_meta(*current) != (size, mtime_ns, dev, inode, file_type)):
+
+                # Changed: new metadata, and all the hashes must be computed again
+
+                new_meta = file_meta(*current)
+                st = current[0]
+                error = (None, None) if (current[1] != None) else (st.errno, st.strerror)
+
+                cnx.execute("UPDATE filelist SET size = ?, mtime_ns = ?, dev = ?, inode = ?, file_type = ?, \
+                                pre_hash = NULL, tail_hash = NULL, sample_hash = NULL, hash = NULL, hash_algo = NULL, disk_offset = NULL, \
+                                size_candidate = NULL, has_duplicate = NULL, marked_for_deletion = NULL, \
+                                access_denied = ?, os_errno = ?, os_strerror = ? WHERE fid = ?",
+                                new_meta + (isinstance(st, PermissionError), error[0], error[1], fid))
+
+                rescan_sizes_add(cnx, size)
+                rescan_sizes_add(cnx, new_meta[0])
+                counts[1] += 1
+
+        # New files
+
+        for name, (st, file_type) in (entries or {}).items():
+
+            if (file_type != None):
+                cnx.execute("INSERT INTO filelist(dir_id, name, access_denied, root_id, master, protected, size, mtime_ns, dev, inode, file_type)\
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (did, name, False, rid, master, protected, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, file_type))
+                rescan_sizes_add(cnx, st.st_size)
+            else:
+                cnx.execute("INSERT INTO filelist(dir_id, name, access_denied, root_id, master, protected, os_errno, os_strerror)\
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (did, name, isinstance(st, PermissionError), rid, master, protected, st.errno, st.strerror))
+
+            counts[0] += 1
+
+    def skip_dir(dirpath, parent, st):
+
+        # Unchanged directory: not listed again
+
+        did = dir_id(dirpath, parent)
+        row = cnx.execute("SELECT mtime_ns FROM directories WHERE did = ?", (did,)).fetchone()
+
+        if (row == None) or (row[0] != st.st_mtime_ns):
+            return None
+
+        if (not utils.rescan_trust_dir_mtime):
+            sync_files(did, dirpath, None)
+
+        cnx.execute("UPDATE directories SET scanned = True WHERE did = ?", (did,))
+        cnx.commit()
+
+        # Its known subdirectories (their IDs are kept for the next calls)
+
+        subdirs = []
+
+        for sub_did, name in cnx.execute("SELECT did, name FROM directories WHERE parent_id = ?", (did,)):
+            path = os.path.join(dirpath, name)
+            dids[path] = sub_did
+            subdirs.append(path)
+
+        return subdirs
+
+    def sync_dir(dirpath, parent, st, entries):
+
+        # Changed (or new) directory: its files are synchronized, then its new mtime is stored, in one transaction
+
+        did = dir_id(dirpath, parent)
+
+        if (did == None):
+            did = directory_insert(cnx, dirpath, dids.get(parent), rid, st.st_mtime_ns, True, True)
+            dids[dirpath] = did
+        else:
+            cnx.execute("UPDATE directories SET mtime_ns = ?, scanned = True WHERE did = ?", (st.st_mtime_ns, did))
+
+        sync_files(did, dirpath, entries)
+
+        cnx.commit()
+
+    #
+    # ---> Walking through the directories (only the changed ones are listed)
+    #
+
+    current = None
+    nb = 0
+
+    for root, entry, st, file_type in scandir_walk(basepath, skip_dir):
+
+        nb = nb + 1
+
+        if (file_type == FILE_TYPE_DIR):
+
+            if (current != None):
+                sync_dir(*current)
+
+            # Here entry is the parent path
+
+            current = (root, entry, st, {})
+
+        else:
+
+            current[3][entry.name] = (st, file_type)
+
+        if ((nb % 100) == 0):
+            print("Rescanning ({} new, {} changed, {} deleted files) {:.2f} sec".format(*counts, chrono.elapsed()), end="\r", flush=True)
+
+    if (current != None):
+        sync_dir(*current)
+
+    #
+    # ---> Vanished directories (and their files)
+    #
+
+    for (did,) in cnx.execute("SELECT did FROM directories WHERE root_id = ? AND scanned IS NULL", (rid,)).fetchall():
+
+        for fid, size in cnx.execute("SELECT fid, size FROM filelist WHERE dir_id = ?", (did,)).fetchall():
+            rescan_sizes_add(cnx, size)
+            counts[2] += 1
+
+        cnx.execute("DELETE FROM filelist WHERE dir_id = ?", (did,))
+        cnx.execute("DELETE FROM directories WHERE did = ?", (did,))
+
+    cnx.commit()
+
+    # End time
+    chrono.stop()
+
+    return chrono.elapsed(), tuple(counts)
+
+
+def file_meta(st, file_type):
+
+    """
+
+        Returns the metadata stored for a file, as in the filelist table.
+
+        Args:
+            st (os.stat_result): The stat of the file, or the OSError we got
+            file_type (text): The file type, None if there was an error
+
+        Returns:
+            (tuple) size, mtime_ns, dev, inode, file_type
+
+    """
+
+    if (file_type == None):
+        return (None, None, None, None, None)
+
+    return (st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, file_type)
+
+
+def rescan_sizes_add(cnx, size):
+
+    """
+
+        Marks a size as affected by the rescan: its groups of duplicates must be computed again.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            size (int): The size (None is ignored)
+
+    """
+
+    if (size != None):
+        cnx.execute("INSERT OR IGNORE INTO rescan_sizes VALUES (?)", (size,))
+
+
+
+def rescan_filter(cnx):
+
+    """
+
+        Returns the SQL condition selecting the files whose groups must be computed: after an incremental
+        rescan, only the files having an affected size, else all the files.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+        Returns:
+            condition (text): SQL condition on the filelist table
+
+    """
+
+    if (cnx.execute("SELECT COUNT(*) FROM rescan_sizes").fetchone()[0] > 0):
+        return "size IN (SELECT size FROM rescan_sizes)"
+    else:
+        return "1"
+
+
+
+def links_propagate(cnx, columns, where):
+
+    """
+
+        Copies the hashes of the first file of each inode (fid = link_id) to its other hardlinks, which are
+        never read.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            columns (list): The columns to copy
+            where (text): SQL condition selecting the files in filelist
+
+    """
+
+    sets = ", ".join("{0} = (SELECT l.{0} FROM filelist l WHERE l.fid = filelist.link_id)".format(column) for column in columns)
+
+    cnx.execute("UPDATE filelist SET {} WHERE link_id != fid AND {}".format(sets, where))
+    cnx.commit()
+
+
+
+#
+#    ====================================================================
+#     Size grouping: only files sharing their size can have duplicates
+#    ====================================================================
+#
+
+def size_grouping(cnx):
+
+    """
+
+        Selects the duplicate candidates by their size, before any file is opened. Two files with a different size
+        are... different! So a file with a unique size can't have any duplicate, and we don't need to hash it at all.
+
+        The size is known since the lookup, so this step is only one SQL query: the regular files whose size is
+        shared by at least another one are flagged 'size_candidate', and only those will be pre-hashed.
+
+        The hardlinks are identified here too ('link_id'): a file and its hardlinks are the same inode, so
+        they are not duplicates of each other, and the inode is read only once.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+
+        Returns:
+            t (time): The execution time of this function
+            nb (int): The number of duplicate candidates
+
+    """
+
+    global last_step, last_id
+
+    # Start time
+    chrono = utils.Chrono()
+    chrono.start()
+
+    #
+    # ---> All-in-one SQL query, like for the duplicates (the step can be replayed as is)
+    #      After an incremental rescan, only the affected sizes are recomputed.
+    #
+
+    sizes = rescan_filter(cnx)
+
+    # Hardlinks first (see links_identify)
+
+    links_identify(cnx, sizes)
+
+    # Then the sizes shared by at least 2 different files (not hardlinks)
+
+    cnx.execute("UPDATE filelist SET size_candidate = NULL WHERE size_candidate NOT NULL AND {}".format(sizes))
+    cnx.execute("UPDATE filelist SET size_candidate = True WHERE file_type = ? AND {} AND size IN \
+        (SELECT size FROM filelist WHERE file_type = ? AND {} GROUP BY size HAVING COUNT(DISTINCT link_id) > 1)".format(sizes, sizes), (FILE_TYPE_REGULAR, FILE_TYPE_REGULAR))
+
+    # Checkpoint
+
+    last_step = "size_grouping"
+    last_id = "all"
+
+    utils.checkpoint_db(cnx, "size_grouping", "all", commit = True)
+
+    r = cnx.execute("SELECT COUNT(*) FROM filelist WHERE size_candidate = True")
+    nb = r.fetchone()[0]
+
+    # End time
+    chrono.stop()
+
+    return chrono.elapsed(), nb
+
+
+def links_identify(cnx, where):
+
+    """
+
+        Identifies the hardlinks: all the files sharing the same device and inode get the fid of the first one as
+        'link_id'. They have the same content for sure, so they are one single file for the duplicates search.
+        (On Windows, the inode is not known: 0)
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            where (text): SQL condition selecting the files
+
+    """
+
+    cnx.execute("UPDATE filelist SET link_id = fid WHERE {}".format(where))
+    cnx.execute("UPDATE filelist SET link_id = \
+        (SELECT MIN(l.fid) FROM filelist l WHERE l.dev = filelist.dev AND l.inode = filelist.inode AND l.file_type = ?) \
+        WHERE file_type = ? AND inode != 0 AND {}".format(where), (FILE_TYPE_REGULAR, FILE_TYPE_REGULAR))
+
+
+
+#
+#    ====================================================================
+#     Parallel hashing (worker pool)
+#    ====================================================================
+#
+
+def hash_executor(workers = None, share = None):
+
+    """
+
+        Creates the pool of workers used to hash the files, as set in utils.py. hashlib releases the GIL while
+        hashing, and the storage can serve many outstanding reads, so threads are usually enough. Processes
+        are available for the algos that don't release the GIL (like crc32 on small blocks).
+
+        Args:
+            workers (int): (Optional) Number of workers, hash_workers by default
+            share (int): (Optional) Number of worker processes sharing the throttle limits (the workers of all
+                         the pools running together), 'workers' by default
+
+        Returns:
+            executor (concurrent.futures.Executor): the pool of workers
+
+    """
+
+    if (workers == None):
+        workers = utils.hash_workers
+
+    if (share == None):
+        share = workers
+
+    if (utils.hash_pool == "process"):
+        return concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = fileio.throttle_share, initargs = (share,))
+    else:
+        return concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+
+
+def device_workers():
+
+    """
+
+        Returns the number of workers of each device set in utils.py (device_workers, given by path). The
+        devices not listed there get hash_workers workers.
+
+        Returns:
+            workers (dict): number of workers, by device ID (st_dev)
+
+    """
+
+    workers = {}
+
+    for path, nb in utils.device_workers.items():
+
+        try:
+            workers[os.stat(path).st_dev] = nb
+        except OSError as ose:
+            print("Device of {} unknown ({}), using {} workers.".format(path, ose.strerror, utils.hash_workers))
+
+    return workers
+
+
+def device_map(func, streams):
+
+    """
+
+        Runs the jobs with one pool of workers and one queue per device: a device only gets the number of
+        workers set for it (see device_workers), and a slow device doesn't stall the others. Results are
+        yielded as soon as they are done, so they are NOT in the order of the arguments: the callers rely on
+        the stored results (not on the last one yielded) to restart.
+
+        Args:
+            func (function): the function to call
+            streams (dict): the arguments (iterable, one element per call), by device ID
+
+        Returns:
+            (generator) of (result, args) tuples, in completion order
+
+    """
+
+    limits = device_workers()
+
+    # The worker processes of all the devices share the throttle limits
+
+    share = sum(limits.get(dev, utils.hash_workers) for dev in streams)
+    process = (utils.hash_pool == "process")
+
+    executors = {}
+    queues = {}
+    window = {}
+
+    for dev, iterable in streams.items():
+        nb = limits.get(dev, utils.hash_workers)
+        executors[dev] = hash_executor(nb, share)
+        queues[dev] = iter(iterable)
+        window[dev] = nb * 4
+
+    pending = {}
+    running = collections.Counter()
+
+    try:
+
+        while True:
+
+            # Each device is fed up to its own window
+
+            for dev in list(queues):
+
+                while (running[dev] < window[dev]):
+
+                    args = next(queues[dev], None)
+
+                    if (args == None):
+                        del queues[dev]
+                        break
+
+                    if (process):
+                        pending[executors[dev].submit(process_job, (func, args))] = (dev, args)
+                    else:
+                        pending[executors[dev].submit(func, args)] = (dev, args)
+                    running[dev] += 1
+
+            if not(pending):
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+
+                dev, args = pending.pop(future)
+                running[dev] -= 1
+
+                if (process):
+                    result, waited = future.result()
+                    fileio.throttle.waited = fileio.throttle.waited + waited
+                else:
+                    result = future.result()
+
+                yield result, args
+
+    finally:
+
+        for executor in executors.values():
+            executor.shutdown(wait = True, cancel_futures = True)
+
+
+def process_job(args):
+
+    """
+
+        Runs a job in a worker process, and returns the time its reads waited for the throttle too (the waiting
+        time of the worker processes is not seen by the main process, see device_map).
+
+        Args:
+            args (tuple): the function to call, and its argument
+
+        Returns:
+            result: the result of the function
+            waited (float): the time spent waiting for the throttle during the job
+
+    """
+
+    func, job_args = args
+
+    waited = fileio.throttle.waited
+    result = func(job_args)
+
+    return result, fileio.throttle.waited - waited
+
+
+def ordered_map(executor, func, iterable, window = None, keep_args = False):
+
+    """
+
+        Like executor.map(), but with a bounded number of pending jobs (executor.map() submits everything first,
+        which is not an option with millions of files). Results are yielded in the same order as the arguments,
+        so the caller can checkpoint on the last yielded element: everything before it is done.
+
+        Args:
+            executor (concurrent.futures.Executor): the pool of workers
+            func (function): the function to call
+            iterable (iterable): the arguments (one per call)
+            window (int): (Optional) max number of pending jobs, by default 4 per worker
+            keep_args (boolean): (Optional) Yields (result, args) tuples instead of the results only
+
+        Returns:
+            (generator) of func results, in order
+
+    """
+
+    if (window == None):
+        window = utils.hash_workers * 4
+
+    pending = collections.deque()
+
+    for args in iterable:
+
+        pending.append((executor.submit(func, args), args))
+
+        if (len(pending) >= window):
+            future, args_done = pending.popleft()
+            yield (future.result(), args_done) if keep_args else future.result()
+
+    while pending:
+        future, args_done = pending.popleft()
+        yield (future.result(), args_done) if keep_args else future.result()
+
+
+def device_streams(cnx, columns, where, params, order):
+
+    """
+
+        Selects the files to read, with one cursor per device (see device_map).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            columns (text): The columns to select
+            where (text): SQL condition selecting the files in filelist
+            params (tuple): Parameters of the SQL condition
+            order (list): The columns giving the order of the reads (see io_order)
+
+        Returns:
+            streams (dict): sqlite3.Cursor objects, by device ID
+
+    """
+
+    r = cnx.execute("SELECT DISTINCT dev FROM filelist WHERE {}".format(where), params)
+
+    return {dev: cnx.execute("SELECT {} FROM filelist WHERE {} AND dev IS ? ORDER BY {}".format(columns, where, ", ".join(order)),
+                                tuple(params) + (dev,)) for (dev,) in r.fetchall()}
+
+
+def hash_job(args):
+
+    """
+
+        Hashes one file in a worker. Exceptions are returned, not raised, so the writer can store them in the
+        database (and because they must be pickled with a process pool).
+
+        Zero-length files are not opened at all.
+
+        Args:
+            args (tuple): (fid, filepath, algo name, pre_hash flag, size)
+
+        Returns:
+            fid (int): the file ID
+            h (text): the hash value, or None in case of error
+            error (tuple): None, or (permission denied flag, errno, strerror)
+
+    """
+
+    fid, filepath, algo_name, pre_hash, size = args
+
+    if (size == 0):
+        return fid, empty_hash(algo_name), None
+
+    try:
+
+        h, _ = file_hash_calc(filepath, algo_name, pre_hash)
+        return fid, h, None
+
+    except PermissionError as pe:
+
+        return fid, None, (True, pe.errno, pe.strerror)
+
+    except OSError as ose:
+
+        return fid, None, (False, ose.errno, ose.strerror)
+
+
+
+#
+#    ====================================================================
+#     Disk locality (order of the reads)
+#    ====================================================================
+#
+
+def file_disk_offset(filename):
+
+    """
+
+        Returns the physical position of the first extent of a file, as given by the FIEMAP ioctl (Linux).
+        Only the metadata is read, not the content of the file.
+
+        Args:
+            filename (text): Full path of the file
+
+        Returns:
+            offset (int): The physical offset (in bytes) of the file on its device, or -1 if unknown
+
+    """
+
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+
+    try:
+
+        with open(filename, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request, True)
+
+    except OSError:
+
+        # Not supported by the filesystem, or no access to the file
+        return -1
+
+    mapped = FIEMAP_HEADER.unpack_from(request)[3]
+
+    if (mapped == 0):
+        return -1
+
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def disk_offset_job(args):
+
+    """
+
+        Worker side of the disk offsets lookup.
+
+        Args:
+            args (tuple): (fid, filepath)
+
+        Returns:
+            fid (int): The file ID
+            offset (int): The physical offset of the file, or -1
+
+    """
+
+    fid, filepath = args
+
+    return fid, file_disk_offset(filepath)
+
+
+def io_order(cnx, where, params = ()):
+
+    """
+
+        Returns the columns of filelist giving the order of the reads, as set in utils.py (io_order). On spinning
+        disks, reading the files in the order of their position on disk avoids most of the seeks:
+
+            - "fid": order of the lookup (directory by directory)
+            - "inode": inode number, on each device (the filesystems tend to allocate near inodes near each other)
+            - "extent": physical position of the first extent (FIEMAP), then inode when it's unknown
+
+        In "extent" mode, the missing positions of the selected files are asked to the filesystem first (a
+        restart or a later step reuses them).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            where (text): SQL condition selecting the files that will be read
+            params (tuple): (Optional) Parameters of the SQL condition
+
+        Returns:
+            columns (list): The columns to use in an ORDER BY clause
+
+    """
+
+    order = utils.io_order
+
+    if (order == "extent") and (fcntl == None):
+        order = "inode"
+
+    if (order == "extent"):
+
+        r = cnx.execute("SELECT fid, dir_path(dir_id), name FROM filelist WHERE disk_offset IS NULL AND {} ORDER BY dev, inode".format(where), params)
+        jobs = ((fid, os.path.join(path, name)) for fid, path, name in r.fetchall())
+
+        offsets = []
+
+        with hash_executor() as executor:
+
+            for fid, offset in ordered_map(executor, disk_offset_job, jobs):
+
+                offsets.append((offset, fid))
+
+                if (len(offsets) >= utils.db_batch_size):
+                    cnx.executemany("UPDATE filelist SET disk_offset = ? WHERE fid = ?", offsets)
+                    cnx.commit()
+                    offsets.clear()
+
+        cnx.executemany("UPDATE filelist SET disk_offset = ? WHERE fid = ?", offsets)
+        cnx.commit()
+
+    return IO_ORDERS[order]
+
+
+
+#
+#    ====================================================================
+#     Streaming pipeline (hashing during the lookup)
+#    ====================================================================
+#
+
+class Pipeline:
+
+    """
+        Hashes the files while the lookup is still running (pipeline = True in utils.py), instead of waiting for
+        the end of the lookup to start the pre-hash step.
+
+        Each file goes through levels: pre-hash, then the intermediate stages (if any, for its size), then the
+        full hash ("hash" verify mode only). A file reaches the next level only when another file has the same
+        key (size, then size and pre-hash, and so on): the first file of a key waits, and when a second one
+        arrives, both are sent to the workers. So a unique file is never read, like with the steps.
+
+        The memory is bounded: at most pipeline_max_keys first files are waiting for another one (beyond that, the
+        new keys are ignored), the keys whose files are sent are forgotten beyond pipeline_max_keys more (their
+        next files wait again), a file carries its own hashes in its job, and at most pipeline_queue_size jobs
+        are waiting for a worker (beyond that, the lookup waits for the workers).
+
+        The results are written like the steps do (a file is done when its hash is stored), in the lookup
+        transactions. The steps run after the lookup anyway, and only compute what's missing: the files left
+        by the pipeline (ignored keys, files found before a restart...) are hashed there.
+    """
+
+    def __init__(self, cnx, algo):
+
+        #
+        # Init function. Only the files inserted after this point are fed to the pipeline.
+        #
+
+        self.cnx = cnx
+        self.algo = algo
+        self.executor = hash_executor()
+        self.window = utils.hash_workers * 4
+
+        # Last fid fed to the pipeline
+        self.fid = cnx.execute("SELECT MAX(fid) FROM filelist").fetchone()[0] or 0
+
+        # First file of each key (fid, filepath, size, dev, inode, hashes so far), or None once the files of the
+        # key are sent, and the number of first files waiting
+        self.first = {}
+        self.waiting = 0
+
+        # Jobs waiting for a worker, jobs sent to the workers (future => job), and the pending updates
+        self.queue = collections.deque()
+        self.pending = {}
+        self.updates = collections.defaultdict(list)
+
+        self.counts = collections.Counter()
+
+
+    def levels(self, size):
+
+        # Levels of a file ("pre", the stages, "full"), depending on its size (see the steps)
+
+        if (size == 0):
+
+            # Nothing to read, the steps will do it
+            return []
+
+        if (size <= PRE_HASH_SIZE):
+            return ["pre"]
+
+        levels = ["pre"]
+
+        if (size > max(PRE_HASH_SIZE, utils.hash_stages_min_size)):
+            levels = levels + utils.hash_stages
+
+        if (utils.verify_mode == "hash"):
+            levels = levels + ["full"]
+
+        return levels
+
+
+    def feed(self):
+
+        # Feeds the files inserted since the last call (the lookup just wrote a batch)
+
+        r = self.cnx.execute("SELECT fid, dir_path(dir_id), name, size, dev, inode FROM filelist WHERE fid > ? AND file_type = ? \
+                                AND os_errno IS NULL ORDER BY fid", (self.fid, FILE_TYPE_REGULAR))
+
+        for fid, path, name, size, dev, inode in r.fetchall():
+            self.fid = fid
+            self.arrive((fid, os.path.join(path, name), size, dev, inode, ()), 0, (size,))
+
+        # Results already there, and backpressure: the lookup waits if the workers are too late
+
+        self.collect(wait = False)
+
+        while (len(self.queue) > utils.pipeline_queue_size):
+            self.collect(wait = True)
+
+        self.write()
+
+
+    def arrive(self, job, level, key):
+
+        # A file reaches a level, with its key (size and hashes of the previous levels)
+
+        levels = self.levels(job[2])
+
+        if (level >= len(levels)):
+            return
+
+        key = (levels[level],) + key
+
+        if (key in self.first):
+
+            first = self.first[key]
+
+            if (first != None):
+
+                # Hardlinks of the same file are not duplicates, we wait for another file
+
+                if (first[3:5] == job[3:5]) and (job[4] != 0):
+                    return
+
+                self.first[key] = None
+                self.waiting = self.waiting - 1
+                self.submit(first, level)
+
+            self.submit(job, level)
+
+        elif (self.waiting < utils.pipeline_max_keys):
+
+            # The keys already sent are forgotten when there are too many of them (their next files wait again)
+
+            if (len(self.first) >= 2 * utils.pipeline_max_keys):
+                self.first = {k: v for k, v in self.first.items() if (v != None)}
+
+            self.first[key] = job
+            self.waiting = self.waiting + 1
+
+
+    def submit(self, job, level):
+
+        # Sends a file to the workers for a level (unless the hash cache already knows it)
+
+        fid, filepath, size = job[:3]
+        name = self.levels(size)[level]
+
+        if (utils.hash_cache):
+
+            column, kind, algo = self.target(name, size)
+
+            h = hashcache.find(self.cnx, kind, algo, fid)
+
+            if (h != None):
+                self.counts["cache"] += 1
+                self.done(job, level, h, None)
+                return
+
+        if (name == "pre"):
+            args = (hash_job, (fid, filepath, self.algo, True, size))
+        elif (name == "full") and (full_hash_algo(self.algo, size) != self.algo):
+            args = (tree_hash_job, (fid, filepath, self.algo, size))
+        elif (name == "full"):
+            args = (hash_job, (fid, filepath, self.algo, False, None))
+        else:
+            args = (stage_job, (fid, filepath, self.algo, name, size))
+
+        self.queue.append((job, level, args))
+        self.pump()
+
+
+    def target(self, name, size):
+
+        # Column, kind of hash (for the cache) and name of the algo of a level
+
+        if (name == "pre"):
+            return "pre_hash", hash_kind("pre"), self.algo
+        elif (name == "full"):
+            return "hash", hash_kind("full"), full_hash_algo(self.algo, size)
+        else:
+            return HASH_STAGES[name], hash_kind(name), self.algo
+
+
+    def pump(self):
+
+        # Sends the waiting jobs to the workers, up to the window
+
+        while (self.queue) and (len(self.pending) < self.window):
+            job, level, (func, args) = self.queue.popleft()
+            self.pending[self.executor.submit(func, args)] = (job, level)
+
+
+    def collect(self, wait):
+
+        # Handles the finished jobs (waiting for at least one if 'wait')
+
+        if not(self.pending):
+            return
+
+        if (wait):
+            finished, _ = concurrent.futures.wait(self.pending, return_when = concurrent.futures.FIRST_COMPLETED)
+        else:
+            finished = [future for future in self.pending if future.done()]
+
+        for future in finished:
+            job, level = self.pending.pop(future)
+            _, h, error = future.result()
+            self.done(job, level, h, error)
+
+        self.pump()
+
+
+    def done(self, job, level, h, error):
+
+        # Stores the result of a level, and sends the file to the next one
+
+        fid, _, size = job[:3]
+
+        if (error != None):
+
+            if (error[0]):
+                self.updates["UPDATE filelist SET access_denied = ? WHERE fid = ?"].append((True, fid))
+            else:
+                self.updates["UPDATE filelist SET os_errno = ?, os_strerror = ? WHERE fid = ?"].append((error[1], error[2], fid))
+
+            return
+
+        name = self.levels(size)[level]
+        column, _, algo = self.target(name, size)
+
+        if (name == "pre") and (size <= PRE_HASH_SIZE):
+
+            # The pre-hash is the full hash
+            self.updates["UPDATE filelist SET pre_hash = ?, hash = ?, hash_algo = ? WHERE fid = ?"].append((h, h, algo, fid))
+
+        elif (name == "full"):
+
+            self.updates["UPDATE filelist SET hash = ?, hash_algo = ? WHERE fid = ?"].append((h, algo, fid))
+
+        else:
+
+            self.updates["UPDATE filelist SET {} = ? WHERE fid = ?".format(column)].append((h, fid))
+
+        self.counts[name if (name in ("pre", "full")) else "stage"] += 1
+
+        # The key of the next level is made of the size and the hashes of this file so far (carried by its job)
+
+        hashes = job[5] + (h,)
+
+        self.arrive(job[:5] + (hashes,), level + 1, (size,) + hashes)
+
+
+    def write(self):
+
+        # Writes the pending updates (the caller commits)
+
+        for sql, values in self.updates.items():
+            self.cnx.executemany(sql, values)
+
+        self.updates.clear()
+
+
+    def drain(self):
+
+        # End of the lookup: the jobs already started are finished, and everything is written
+
+        while (self.pending) or (self.queue):
+            self.collect(wait = True)
+
+        self.write()
+        self.cnx.commit()
+
+        self.executor.shutdown()
+        self.first.clear()
+        self.waiting = 0
+
+
+
+#
+#    ====================================================================
+#     File list pre hash calculation (for all files)
+#    ====================================================================
+#
+
+def filelist_pre_hash(cnx, algo):
+
+    """
+
+        Calculates a "pre-hash" that is a hash calculated on the first bytes of the file. Only the files selected
+        by the size grouping step (same size as at least another file) are read.
+
+        Listen to me well: hash calculation can be long for... long files. Here we make a first *selection*
+        where we eliminate files without duplicates. As a matter of fact, if the hash of the first
+        bytes are not equals, it means that the files are... not equals for sure!
+
+        On the other hand, files with the same pre-hash need further investigation and we'll 
+        calculate in the next step the complete hash, but only for duplicate candidates. Then
+        we avoid unnecessary long calculation, especially for big files.
+
+        Though you can use any system-known hash function, we suggest to use only **md5** for 
+        pre-hashing, because it has enough entropy for our usage, and it's quicker in most situations.
+        Better algos will have better result, but here we only want some file duplicate candidate selection.
+
+        The files are hashed by a pool of workers (see hash_workers in utils.py), while this function is the
+        only database writer: each device has its own workers and queue (see device_map), results come back
+        as soon as they are done and are written in batches, with the checkpoint (last fid written) in the same
+        transaction. A file is done when its pre-hash (or its error) is stored, so a restart only reads the
+        missing ones, whatever the order.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            algo (text): Name of the hash algo to use. 
+
+        Returns:
+            t (time): The execution time of this function
+
+    """
+
+    global last_step, last_id, writer
+
+    # Start time
+    chrono = utils.Chrono()
+    chrono.start()
+
+    #
+    # ---> Main loop (on all files)
+    #
+
+    # Only the size candidates are hashed (the size is already known since the lookup, no need to stat again)
+
+    res = cnx.execute("SELECT count(fid) FROM filelist WHERE size_candidate = True AND fid = link_id")
+    nb_total = res.fetchone()[0]
+
+    # The pre-hashes already known by the hash cache are not computed again
+
+    if (utils.hash_cache):
+
+        nb_cached = hashcache.load(cnx, "pre_hash", hash_kind("pre"), algo, "size_candidate = True AND fid = link_id")
+        cnx.execute("UPDATE filelist SET hash = pre_hash, hash_algo = ? WHERE size_candidate = True AND size <= ? AND hash IS NULL AND pre_hash NOT NULL", (algo, PRE_HASH_SIZE))
+        print("{} pre-hashes found in the hash cache.".format(nb_cached))
+
+    res = cnx.execute("SELECT count(fid) FROM filelist WHERE size_candidate = True AND fid = link_id AND pre_hash NOT NULL")
+    nb = res.fetchone()[0]
+
+    # Only one file per inode is read (the other hardlinks get its pre-hash at the end)
+
+    todo = "size_candidate = True AND fid = link_id AND pre_hash IS NULL AND os_errno IS NULL AND NOT access_denied"
+
+    if (last_step == "filelist_pre_hash"):
+        print("Restart: pre-hash of the remaining files")
+
+    order = io_order(cnx, todo)
+    streams = device_streams(cnx, "fid, dir_path(dir_id), name, size", todo, (), order)
+
+    # The rows are streamed to the workers, each device only holds a bounded window of them
+
+    jobs = {dev: ((fid, os.path.join(path, name), algo, True, size) for fid, path, name, size in r) for dev, r in streams.items()}
+
+    # The results are written by the database writer (in batches, without waiting for the commits). For the
+    # files no larger than the pre-hash window, the pre-hash is the full hash: no need to read them again in
+    # the next step.
+
+    writer = dbwriter.DbWriter(cnx)
+
+    for (fid, h, error), (_, _, _, _, size) in device_map(hash_job, jobs):
+
+        if (error == None):
+
+            if (size <= PRE_HASH_SIZE):
+                writer.write("UPDATE filelist SET pre_hash = ?, hash = ?, hash_algo = ? WHERE fid = (?)", (h, h, algo, fid))
+            else:
+                writer.write("UPDATE filelist SET pre_hash = ? WHERE fid = (?)", (h, fid))
+
+        else:
+
+            #
+            # Here we have an existing file but we have no right permission on it. Bad strike!
+            #
+            # Worst: we have an OS Error while retrieving file information or during hash calculation
+            #
+            # Example: We'll get an #22 error with an OneDrive file stored only in the cloud and not present on disk
+            #
+
+            error_write(writer, fid, error)
+
+        nb = nb + 1
+
+        # Checkpoint (written with the results)
+
+        last_step = "filelist_pre_hash"
+        last_id = fid
+
+        writer.checkpoint(last_step, last_id)
+
+        # Displaying progression
+
+        if ((nb % 100) == 0):
+
+            perc = (nb / nb_total) * 100
+            print("Quick hash computing #{} files ({:.2f}%), {:.2f} sec".format(nb, perc, chrono.elapsed()), end="\r", flush=True)
+
+    writer_close(writer)
+
+    links_propagate(cnx, ["pre_hash", "hash", "hash_algo"], "size_candidate = True")
+
+    if (utils.hash_cache):
+        hashcache.store(cnx, "pre_hash", hash_kind("pre"), algo, "size_candidate = True AND fid = link_id")
+
+    #
+    #  ---> Last commit
+    #
+
+    last_step = "filelist_pre_hash"
+    last_id = "all"
+
+    utils.checkpoint_db(cnx, "filelist_pre_hash", "all", commit = True)
+
+    # End time
+    chrono.stop()
+
+    return chrono.elapsed()
+
 
-def checkpoint_db(cnx, last_step, last_id = None, commit = False):
+def error_write(writer, fid, error):
 
     """
 
-        Sets the status of the current process by storing the name of the last well-executed step.
+        Writes the error of a file (see hash_job): access denied, or the OS error.
 
         Args:
-            cnx (sqlite3.Connection): Connection object
-            last_step (text): Name of the last well-executed step
+            writer (dbwriter.DbWriter): The database writer of the step
+            fid (int): File ID
+            error (tuple): (access denied, errno, strerror)
+
+    """
+
+    if (error[0]):
+        writer.write("UPDATE filelist SET access_denied = ? WHERE fid = (?)", (True, fid))
+    else:
+        writer.write("UPDATE filelist SET os_errno = ?, os_strerror=? WHERE fid = (?)", (error[1], error[2], fid))
 
-        Returns:
-            nothing
+
+def writer_close(w):
 
     """
 
-    cnx.execute("UPDATE params SET value=? WHERE key='last_step'", (last_step,))
-    cnx.execute("UPDATE params SET value=? WHERE key='last_id'", (last_id,))
+        Closes the database writer of a step: everything it got is committed (with the last checkpoint).
 
-    if (commit):
-        cnx.commit()
+        Args:
+            w (dbwriter.DbWriter): The database writer of the step
 
-    return 
+    """
+
+    global writer
+
+    writer = None
+    w.close()
 
 
 
 #
 #    ====================================================================
-#     Directory calculation (for all files in many directories)
+#     Progressive hashing (intermediate stages between the pre-hash and the full hash)
 #    ====================================================================
 #
 
-def directories_lookup(cnx, basepath_list):
+def candidate_key(stages):
 
     """
+
+        Returns the SQL expressions identifying a group of duplicate candidates after some intermediate stages:
+        the size, the pre-hash, and the hash of each stage. A stage is not computed for the small files (see
+        hash_stages_min_size), hence the COALESCE.
+
         Args:
-            cnx (sqlite3.Connection): Connection object
-            basepath (text): Array of file paths we will look into.
+            stages (list): Names of the stages already computed
 
         Returns:
-            t (time): The execution time of this function
-            nb_to_process (int): The number of files we have to process   
+            key (list): SQL expressions
 
     """
-                
-    t_elaps = 0.0
-
-    # We look for the directories already looked up
-
-    completed_dir = []
 
-    res = cnx.execute("SELECT ALL value FROM params WHERE key = 'completed_dir'")
+    return ["size", "pre_hash"] + ["COALESCE({}, '')".format(HASH_STAGES[stage]) for stage in stages]
 
-    for dir_name in res:
-        completed_dir.append(dir_name[0])
-        print(FMT_STR_COMPLETED_DIR.format(dir_name[0]))
 
-    # Loop over directories
+def stage_job(args):
 
-    for basepath in basepath_list:
+    """
 
-        line        = basepath.rstrip("\n").split(";")
+        Computes an intermediate stage hash of one file in a worker (see hash_job).
 
-        if line[0] != '':
+        Args:
+            args (tuple): (fid, filepath, algo name, stage, size)
 
-            p_master, p_protected, path = line
+        Returns:
+            fid (int): the file ID
+            h (text): the hash value, or None in case of error
+            error (tuple): None, or (permission denied flag, errno, strerror)
 
-            # If the directory has been completed, we skip it. Else, we restart the lookup from the beginning.
+    """
 
-            if (path not in completed_dir):
+    fid, filepath, algo_name, stage, size = args
 
-                # Restart point here. We delete what has been done for this directory (for it has not been completed)
-                cnx.execute("DELETE FROM filelist WHERE original_path=?", (path,))
-                cnx.commit()
+    try:
 
-                print(FMT_STR_CONSIDERING_DIR.format(path, bool(int(p_master)), bool(int(p_protected))))
-                t = directory_lookup(cnx, path, p_master, p_protected)
-                
-                t_elaps += t
+        return fid, file_stage_hash(filepath, algo_name, stage, size), None
 
-    # Returning nb of files to process in the table. Should be the same as nb...
+    except PermissionError as pe:
 
-    r = cnx.execute("SELECT COUNT(*) FROM filelist")
-    nb_to_process = r.fetchone()[0]
+        return fid, None, (True, pe.errno, pe.strerror)
 
-    return t_elaps, nb_to_process
+    except OSError as ose:
 
+        return fid, None, (False, ose.errno, ose.strerror)
 
-#
-#    ====================================================================
-#     Directory calculation (for all files in one directory)
-#    ====================================================================
-#
 
-def directory_lookup(cnx, basepath, master, protected):
+def progressive_rehash(cnx, algo):
 
     """
 
-        Looks (hierarchically) for all files within the folder structure, and stores the path and the 
-        name of each file. No file access is made (to save time).
+        Runs the intermediate hash stages set in utils.py (hash_stages), between the pre-hash and the full hash.
+        Each stage only reads the files of the groups that survived the previous stages (same size, same
+        pre-hash, same hash for the previous stages), and the files bigger than hash_stages_min_size (for the
+        small ones, the full hash is cheap enough).
+
+        A file is done when its stage hash is stored, so a restart only recomputes the missing ones.
 
         Args:
             cnx (sqlite3.Connection): Connection object
-            basepath (text): Array of file paths we will look into.
+            algo (text): Name of the hash algo to use
 
         Returns:
             t (time): The execution time of this function
+            nb (int): The number of files read
 
     """
 
-    global last_step, last_id
+    global last_step, last_id, writer
 
     # Start time
     chrono = utils.Chrono()
     chrono.start()
 
-    # Nb of files init
     nb = 0
+    min_size = max(PRE_HASH_SIZE, utils.hash_stages_min_size)
 
-    # Filepath init
+    for i, stage in enumerate(utils.hash_stages):
 
-    if (basepath == ""):
-        basepath = "."
+        column = HASH_STAGES[stage]
+        key = ", ".join(candidate_key(utils.hash_stages[:i]))
 
-    #
-    # ---> Files discovering. Thanks to Python, we just need to call an existing function...
-    #
+        if (utils.hash_cache):
+            hashcache.load(cnx, column, hash_kind(stage), algo, "size > {} AND {}".format(min_size, CANDIDATE_FILTER))
 
-    for root, _, files in os.walk(basepath, topdown=True):
+        # Files of the surviving groups, without this stage hash yet
 
-        #
-        #  We just look for files, we don't process the directories
-        #
+        todo = "size > ? AND {} IS NULL AND {} AND ({}) IN \
+                    (SELECT {} FROM filelist WHERE size > ? AND {} GROUP BY {} HAVING COUNT(*) > 1)" \
+                    .format(column, CANDIDATE_FILTER, key, key, CANDIDATE_FILTER, key)
 
-        for name in files:
+        nb_total = cnx.execute("SELECT COUNT(*) FROM filelist WHERE " + todo, (min_size, min_size)).fetchone()[0]
+        order = io_order(cnx, todo, (min_size, min_size))
+        streams = device_streams(cnx, "fid, dir_path(dir_id), name, size", todo, (min_size, min_size), order)
 
-            # Hey, we got one (file)!
+        jobs = {dev: ((fid, os.path.join(path, name), algo, stage, size) for fid, path, name, size in r) for dev, r in streams.items()}
 
-            nb = nb + 1
-            cnx.execute("INSERT INTO filelist(path, name, access_denied, original_path, master, protected)\
-                            VALUES (?, ?, ?, ?, ?, ?)",(root, name, False, basepath, master, protected))
+        last_step = "progressive_rehash"
+        last_id = stage
 
-            # Checkpoint
+        writer = dbwriter.DbWriter(cnx)
 
-            last_step = "directory_lookup"
-            last_id = "in progress"
+        for n, ((fid, h, error), _) in enumerate(device_map(stage_job, jobs), 1):
 
-            # Displaying progression and commit (occasionnaly)
+            if (error == None):
+                writer.write("UPDATE filelist SET {} = ? WHERE fid = (?)".format(column), (h, fid))
+            else:
+                error_write(writer, fid, error)
 
-            if ((nb % 100) == 0):
-                print("Discovering #{} files ({:.2f} sec)".format(nb, chrono.elapsed()), end="\r", flush=True)
-                if ((nb % 1000) == 0):
-                    cnx.commit()
+            writer.checkpoint(last_step, last_id)
 
-            """
-            except PermissionError:
+            if ((n % 100) == 0):
+                perc = (n / nb_total) * 100
+                print("Stage '{}' hash computing #{} files ({:.2f}%), {:.2f} sec".format(stage, n, perc, chrono.elapsed()), end="\r", flush=True)
 
-                cnx.execute("INSERT INTO filelist(pre_hash, path, name, access_denied)\
-                                VALUES (?, ?, ?, ?)",("?", root, name, True))
+        writer_close(writer)
 
-            except OSError as ose:
+        links_propagate(cnx, [column], "size > {} AND pre_hash NOT NULL".format(min_size))
+
+        if (utils.hash_cache):
+            hashcache.store(cnx, column, hash_kind(stage), algo, "size > {} AND fid = link_id".format(min_size))
 
-                cnx.execute("INSERT INTO filelist(pre_hash, path, name, os_errno, os_strerror)\
-                                VALUES (?, ?, ?, ?, ?)",("?", root, name, ose.errno, ose.strerror))
-            """
+        nb = nb + nb_total
 
     #
-    # ---> Last commit
+    #  ---> Last commit
     #
 
-    utils.checkpoint_db(cnx, "directory_lookup", basepath, commit = True)
+    last_step = "progressive_rehash"
+    last_id = "all"
+
+    utils.checkpoint_db(cnx, "progressive_rehash", "all", commit = True)
 
     # End time
     chrono.stop()
 
-    return chrono.elapsed()
+    return chrono.elapsed(), nb
 
 
 
 #
 #    ====================================================================
-#     File list pre hash calculation (for all files)
+#     Lockstep comparison of a group of files (alternative to the full hash)
 #    ====================================================================
 #
 
-def filelist_pre_hash(cnx, algo):
+def group_compare(filepaths, chunk_size = None):
 
     """
 
-        Calculates a "pre-hash" that is a hash calculated on the first bytes of the file. 
-
-        Listen to me well: hash calculation can be long for... long files. Here we make a first *selection*
-        where we eliminate files without duplicates. As a matter of fact, if the hash of the first
-        bytes are not equals, it means that the files are... not equals for sure!
-
-        On the other hand, files with the same pre-hash need further investigation and we'll 
-        calculate in the next step the complete hash, but only for duplicate candidates. Then
-        we avoid unnecessary long calculation, especially for big files.
-
-        Though you can use any system-known hash function, we suggest to use only **md5** for 
-        pre-hashing, because it has enough entropy for our usage, and it's quicker in most situations.
-        Better algos will have better result, but here we only want some file duplicate candidate selection.
+        Compares the content of a group of files (same size, same pre-hash) by reading them all together, chunk
+        by chunk. After each chunk, the group is split by content: as soon as a file differs from all the others,
+        we stop reading it. If the files differ in their first MB, we don't read the rest, whereas a full hash
+        reads all of them until the end.
 
         Args:
-            cnx (sqlite3.Connection): Connection object
-            algo (text): Name of the hash algo to use. 
+            filepaths (list): Absolute paths of the files
+            chunk_size (int): (Optional) Number of bytes read at once in each file (compare_chunk_size by default)
 
         Returns:
-            t (time): The execution time of this function
+            classes (list): Lists of indexes (in filepaths) of identical files. A file without any duplicate is
+                            alone in its list.
+            errors (dict): index => OSError, for the files we couldn't read (they are in no class)
 
     """
 
-    global last_step, last_id
+    if (chunk_size == None):
+        chunk_size = utils.compare_chunk_size
 
-    # Start time
-    chrono = utils.Chrono()
-    chrono.start()
+    files = {}
+    errors = {}
+    classes = []
 
-    #
-    # ---> Main loop (on all files)
-    #
+    try:
 
-    res = cnx.execute("select count(fid) from filelist;")
-    nb_total = res.fetchone()[0]
-    
-    
-    if (last_step != "filelist_pre_hash"):
+        for i, filepath in enumerate(filepaths):
+            try:
+                files[i] = fileio.FileReader(filepath)
+            except OSError as ose:
+                errors[i] = ose
 
-        nb = 0
-        r = cnx.execute("SELECT * FROM filelist ORDER BY fid")
+        # The groups still being compared. All of them are made of the same content so far.
 
-    else:
+        groups = [list(files)]
 
-        res = cnx.execute("SELECT count(fid) FROM filelist WHERE fid <=? ORDER BY fid", (last_id,))
-        nb = res.fetchone()[0]
-        r = cnx.execute("SELECT * FROM filelist WHERE fid >? ORDER BY fid", (last_id,))
-        print("Restart from fid {}".format(last_id))
+        while groups:
 
-    for row in r:
+            next_groups = []
 
-        # Let's get the filepath of this element
+            for group in groups:
 
-        fid = row[0]
-        filepath = os.path.join(row[3], row[4])
+                # Reading the next chunk of each member, and splitting the group by content
 
-        try:
+                split = {}
 
-            file_stats = os.stat(filepath)
-            file_size = file_stats.st_size 
-            h, _ = file_hash_calc(filepath, algo)
-            cnx.execute("UPDATE filelist SET size = ?, pre_hash = ? WHERE fid = (?)", (file_size, h, fid))
+                for i in group:
+                    try:
+                        data = files[i].read(chunk_size)
+                    except OSError as ose:
+                        errors[i] = ose
+                        continue
+                    split.setdefault(data, []).append(i)
 
-            # Checkpoint
+                for data, members in split.items():
 
-            last_step = "filelist_pre_hash"
-            last_id = fid
+                    if (len(members) == 1) or (not data):
 
-        except PermissionError as pe:
+                        # A singleton (no need to read it any more), or files identical until the end
 
-            #
-            # Here we have an existing file but we have no right permission on it. Bad strike!
-            # 
+                        classes.append(members)
 
-            cnx.execute("UPDATE filelist SET size = ?, access_denied = ? WHERE fid = (?)", (file_size, True, fid))
+                    else:
 
-        except OSError as ose:
+                        next_groups.append(members)
 
-            #
-            # Worst: we have an OS Error while retrieving file information or during hash calculation
-            #
-            # Example: We'll get an #22 error with an OneDrive file stored only in the cloud and not present on disk
-            #
-            
-            cnx.execute("UPDATE filelist SET os_errno = ?, os_strerror=? WHERE fid = (?)", (ose.errno, ose.strerror, fid))
+            groups = next_groups
 
+    finally:
 
-        nb = nb + 1
+        for f in files.values():
+            f.close()
 
-        # Displaying progression and commit (occasionnaly)
+    return classes, errors
 
-        if ((nb % 100) == 0):
 
-            perc = (nb / nb_total) * 100
-            print("Quick hash computing #{} files ({:.2f}%), {:.2f} sec".format(nb, perc, chrono.elapsed()), end="\r", flush=True)
-            if ((nb % 1000) == 0):
-                utils.checkpoint_db(cnx, "filelist_pre_hash", fid, commit = True)
+#
+#    ====================================================================
+#     Full hash (or comparison) of a group of duplicate candidates
+#    ====================================================================
+#
 
-    #
-    #  ---> Last commit
-    #
+def rehash_job(args):
 
-    utils.checkpoint_db(cnx, "filelist_pre_hash", "all", commit = True)
+    """
 
-    # End time
-    chrono.stop()
+        Verifies one group of duplicate candidates in a worker, either by computing the full hash of each file
+        or by comparing their content (see verify_mode in utils.py).
 
-    return chrono.elapsed()
+        In "compare" mode, the 'hash' of a file is b"cmp:" followed by the smallest fid of the identical files,
+        so the identical files share the same value and the different ones don't. Too big groups (more files
+        than compare_max_open) are hashed, to avoid running out of file descriptors.
+
+        The very big files get a tree hash (see file_tree_hash), computed with several readers.
+
+        Args:
+            args (tuple): (algo name, verify mode, size, [(fid, filepath), ...], group ID). The group ID
+                          ("size:pre_hash:...") is only used by the writer, for the checkpoint.
+
+        Returns:
+            (list) of (fid, hash, hash_algo, error) tuples, error being None or (permission denied flag, errno, strerror),
+            hash_algo being the name of the algo recorded with the hash ("cmp" in "compare" mode)
+
+    """
+
+    algo_name, mode, size, members, _ = args
+
+    results = []
+
+    if (mode == "compare") and (len(members) <= utils.compare_max_open):
 
+        classes, errors = group_compare([filepath for _, filepath in members])
+
+        for c in classes:
+            h = "cmp:{}".format(min(members[i][0] for i in c)).encode()
+            for i in c:
+                results.append((members[i][0], h, "cmp", None))
+
+        for i, ose in errors.items():
+            results.append((members[i][0], None, None, (isinstance(ose, PermissionError), ose.errno, ose.strerror)))
+
+    else:
+
+        name = full_hash_algo(algo_name, size)
+
+        for fid, filepath in members:
+            if (name != algo_name):
+                fid, h, error = tree_hash_job((fid, filepath, algo_name, size))
+            else:
+                fid, h, error = hash_job((fid, filepath, algo_name, False, None))
+            results.append((fid, h, name, error))
+
+    return results
 
 
 #
@@ -689,89 +3126,131 @@ def filelist_pre_hash(cnx, algo):
 #    ====================================================================
 #
 
-def pre_duplicates_rehash(cnx):
+def pre_duplicates_rehash(cnx, algo):
 
     """
-        Recalculates full hash for duplicate candidates (files having the same pre-hash). You can use here
-        the hash function you want but consider "md5" as the best ratio entropy/execution time. The updates
-        are made directly in the database.
+        Recalculates full hash for duplicate candidates (files having the same size and pre-hash), with the hash
+        algo set in utils.py (hash_algo, see hashalgo; bench.py can compare them). The updates are made directly
+        in the database, with the name of the algo (hash_algo column).
+
+        With verify_mode = "compare" (utils.py), the files of a group are compared chunk by chunk instead of
+        being hashed (see group_compare). The groups are processed by the pools of workers (one per device), and
+        the results are written in batches as the groups complete, with the last completed group as checkpoint.
 
         Args:
             cnx (sqlite3.Connection): Connection object
+            algo (text): Name of the hash algo to use
 
         Returns:
             t (time): The execution time of this function
     """
 
-    global last_step, last_id
+    global last_step, last_id, writer
 
     # Start time
     chrono = utils.Chrono()
     chrono.start()
 
     #
-    # ---> Selection of pre_hashes present more than once 
+    # ---> Selection of (size, pre_hash) groups present more than once. Two files with the same pre_hash
+    #      but different sizes are different: we never read them entirely. Same thing for the hashes of
+    #      the intermediate stages, if any (see progressive_rehash).
+    #      The files no larger than the pre-hash window already have their full hash (see filelist_pre_hash).
     #
 
-    res = cnx.execute("SELECT count(fid) FROM filelist WHERE pre_hash IN (SELECT pre_hash FROM filelist GROUP BY pre_hash HAVING COUNT(pre_hash) > 1 ORDER BY pre_hash);")
-    nb_total = res.fetchone()[0]
-    
-    if (last_step != "pre_duplicates_rehash"):
+    key_list = candidate_key(utils.hash_stages)
+
+    # The full hashes already known by the hash cache are not computed again (in "compare" mode, there's no hash)
+
+    use_cache = utils.hash_cache and (utils.verify_mode == "hash")
+
+    if (use_cache):
+
+        nb_cached = 0
 
-        # Here we start from the beginning and read all the files in DB
-        nb = 0
-        res = cnx.execute("SELECT pre_hash FROM filelist GROUP BY pre_hash HAVING COUNT(pre_hash) > 1 ORDER BY pre_hash")
+        for condition, name in full_hash_algos(algo):
+            where = "size > {} AND {} AND {}".format(PRE_HASH_SIZE, condition, CANDIDATE_FILTER)
+            nb_cached = nb_cached + hashcache.load(cnx, "hash", hash_kind("full"), name, where)
+            cnx.execute("UPDATE filelist SET hash_algo = ? WHERE hash NOT NULL AND hash_algo IS NULL AND {}".format(where), (name,))
 
+        print("{} full hashes found in the hash cache.".format(nb_cached))
+
+    # The groups are read in disk order (by the smallest position of their files, see io_order), with one queue
+    # per device (a group goes to the smallest device of its files, see device_map). A group is done when all
+    # its files have their full hash (or comparison result), so a restart only selects the groups not done yet,
+    # whatever the order.
+
+    if (last_step == "pre_duplicates_rehash"):
+        print("Restart: full hash of the remaining groups")
+
+    order = io_order(cnx, "size > ? AND hash IS NULL AND {}".format(CANDIDATE_FILTER), (PRE_HASH_SIZE,))
+
+    # The candidates, with their group, in one pass (the totals come with it)
+
+    nb_total, nb = rehash_candidates(cnx, key_list, order)
+
+    keys = ", ".join("key_{}".format(i) for i in range(len(key_list)))
+
+    if (order == IO_ORDERS["fid"]):
+        group_order = keys
     else:
+        group_order = ", ".join(["group_{}".format(column) for column in order] + [keys])
+
+    r = cnx.execute("SELECT DISTINCT group_dev FROM rehash_candidates WHERE n_hash < n")
 
-        # Checkpoint/restart : we restart from last updated record (fid)
+    # The key columns are selected (the groups are made on them), and sorted after the position of the group
 
-        res = cnx.execute("SELECT count(fid) FROM filelist WHERE hash NOT NULL")
-        nb = res.fetchone()[0]
+    streams = {dev: cnx.execute("SELECT fid, dir_path(dir_id), name, hash, {keys} FROM rehash_candidates WHERE n_hash < n AND group_dev IS ? \
+                                    ORDER BY {group_order}, {order}".format(keys = keys, group_order = group_order, order = ", ".join(order)), (dev,))
+                for (dev,) in r.fetchall()}
 
-        # Restart point
+    #
+    # ---> The groups are sent to the workers. The files of a group are consecutive in the stream.
+    #      A file that already has its full hash (from the cache, or unchanged since the last scan) is not read
+    #      again. In "compare" mode, the whole group is compared again if one of its files has no result yet.
+    #
 
-        res = cnx.execute("SELECT pre_hash FROM filelist WHERE pre_hash >? GROUP BY pre_hash HAVING COUNT(pre_hash) > 1 ORDER BY pre_hash", (last_id,))
-        print("Restart from pre_hash {}".format(last_id))
+    def group_jobs(res):
 
-    # Progression 
+        for group, rows in itertools.groupby(res, key = lambda row: row[4:]):
+            rows = list(rows)
+            if (utils.verify_mode == "hash"):
+                rows = [row for row in rows if row[3] == None]
+            members = [(row[0], os.path.join(row[1], row[2])) for row in rows]
+            yield algo, utils.verify_mode, group[0], members, ":".join(k.hex() if isinstance(k, bytes) else str(k) for k in group)
+
+    # Progression. The results are written by the database writer, with the last completed group as checkpoint.
 
     last_d = 0
-    last_m = 0
 
-    # Loop...
+    jobs = {dev: group_jobs(res) for dev, res in streams.items()}
 
-    for h in res:
+    writer = dbwriter.DbWriter(cnx)
 
-        #
-        # We look for all files that have the selected pre_hash
-        # 
+    for results, (_, _, _, members, group_id) in device_map(rehash_job, jobs):
 
-        hash = h[0]
-        r = cnx.execute("SELECT * FROM filelist WHERE pre_hash = ?", (hash, ))
+        # Here we need to go a bit further: having the same pre_hash
+        # does not mean that files are identical; we got the complete hash (or comparison)
 
-        for row in r:
+        for fid, h, name, error in results:
 
-            # Here we need to go a bit further: having the same pre_hash
-            # does not mean that files are identical; we need to calculate the complete hash
+            if (error == None):
+                writer.write("UPDATE filelist SET hash = ?, hash_algo = ? WHERE fid = (?)", (h, name, fid))
+            else:
+                error_write(writer, fid, error)
 
-            fid = row[0]
-            filepath = os.path.join(row[3], row[4])
-            full_hash, _ = file_hash_calc(filepath, "md5", False)
+        # The whole group is done, it can be the checkpoint
 
-            cnx.execute("UPDATE filelist set hash = ? WHERE fid = (?)", (full_hash, fid))
+        last_step = "pre_duplicates_rehash"
+        last_id = group_id
 
-            # Checkpoint
-            
-            last_step = "pre_duplicates_rehash"
-            last_id = hash
+        writer.checkpoint(last_step, last_id)
 
-            nb = nb + 1
+        nb = nb + len(members)
 
-        # Displaying progression and commit (occasionnaly, but only when we get a new hash)
+        # Displaying progression
 
         d = nb // 100
-        m = nb // 1000
 
         if (d != last_d):
 
@@ -779,14 +3258,24 @@ def pre_duplicates_rehash(cnx):
             perc = (nb / nb_total) * 100
             print("Rehashing duplicate candidates #{} ({:.2f}%), {:.2f} sec".format(nb, perc, chrono.elapsed()), end="\r", flush=True)
 
-            if (m != last_m):
-                last_m = m
-                utils.checkpoint_db(cnx, "pre_duplicates_rehash", fid, commit = True)
+    writer_close(writer)
+
+    cnx.execute("DROP TABLE rehash_candidates")
+
+    links_propagate(cnx, ["hash", "hash_algo"], "size > {} AND pre_hash NOT NULL".format(PRE_HASH_SIZE))
+
+    if (use_cache):
+        for condition, name in full_hash_algos(algo):
+            hashcache.store(cnx, "hash", hash_kind("full"), name, "size > {} AND {} AND hash_algo = '{}' AND {}"
+                                .format(PRE_HASH_SIZE, condition, name, CANDIDATE_FILTER))
         
     #
     #  ---> Last commit
     #
     
+    last_step = "pre_duplicates_rehash"
+    last_id = "all"
+
     utils.checkpoint_db(cnx, "pre_duplicates_rehash", "all", commit = True)
 
     # End time
@@ -795,6 +3284,44 @@ def pre_duplicates_rehash(cnx):
     return chrono.elapsed(), nb
 
 
+def rehash_candidates(cnx, key_list, order):
+
+    """
+
+        Selects the duplicate candidates in a temporary table (rehash_candidates), in one pass over filelist:
+        each file comes with the values of its group (window functions over the key), so the groups can then be
+        read in one ordered stream, with no query per group. Only the groups of several files are kept.
+
+        Columns: the file (fid, dir_id, name, hash, and the columns of 'order'), its group key (key_0, key_1...),
+        the size of the group (n), its number of full hashes already known (n_hash, the group is done when
+        n_hash = n), the smallest device of its files (group_dev, MIN(dev)) and the smallest value of each column of 'order'
+        (group_<column>, the position of the group for the reads).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            key_list (list): SQL expressions identifying a group (see candidate_key)
+            order (list): Columns giving the order of the reads (see io_order)
+
+        Returns:
+            nb_total (int): The number of candidates
+            nb (int): The number of candidates already having their full hash
+
+    """
+
+    columns = ["fid", "dir_id", "name", "hash"] + [column for column in order if (column != "fid")]
+    keys = ["{} AS key_{}".format(k, i) for i, k in enumerate(key_list)]
+    groups = ["MIN({0}) OVER g AS group_{0}".format(column) for column in ["dev"] + [c for c in order if (c != "dev")]]
+
+    cnx.execute("DROP TABLE IF EXISTS temp.rehash_candidates")
+
+    cnx.execute("CREATE TEMP TABLE rehash_candidates AS SELECT * FROM (\
+                    SELECT {}, {}, COUNT(*) OVER g AS n, COUNT(hash) OVER g AS n_hash, {} \
+                    FROM filelist WHERE size > ? AND {} WINDOW g AS (PARTITION BY {})) WHERE n > 1"
+                    .format(", ".join(columns), ", ".join(keys), ", ".join(groups), CANDIDATE_FILTER, ", ".join(key_list)), (PRE_HASH_SIZE,))
+
+    return cnx.execute("SELECT COUNT(*), COUNT(hash) FROM rehash_candidates").fetchone()
+
+
 #
 #    ====================================================================
 #     Selecting "true" duplicates (= having the same hash ;)
@@ -830,8 +3357,19 @@ def duplicates_update(cnx):
     #   . The SELECT used in the 'IN' clause where we select (complete) hashes present more than once.
     #
 
-    cnx.execute("UPDATE filelist SET has_duplicate = True WHERE hash IN \
-        (SELECT hash FROM filelist WHERE hash NOT NULL GROUP BY hash HAVING COUNT(hash) > 1 ORDER BY hash)")
+    # After an incremental rescan, only the affected sizes are recomputed (the same hash means the same size).
+    # Their files not trashed yet are unmarked: clean.py marks them again from the new duplicates.
+
+    sizes = rescan_filter(cnx)
+
+    cnx.execute("UPDATE filelist SET has_duplicate = NULL WHERE has_duplicate NOT NULL AND {}".format(sizes))
+    cnx.execute("UPDATE filelist SET marked_for_deletion = NULL WHERE marked_for_deletion NOT NULL AND trashed IS NULL AND {}".format(sizes))
+    cnx.execute("UPDATE filelist SET has_duplicate = True WHERE {} AND (hash_algo, hash) IN \
+        (SELECT hash_algo, hash FROM filelist WHERE hash NOT NULL AND {} GROUP BY hash_algo, hash HAVING COUNT(DISTINCT link_id) > 1)".format(sizes, sizes))
+
+    # The rescan is completely taken into account
+
+    cnx.execute("DELETE FROM rescan_sizes")
         
     #
     #  ---> Last commit
@@ -879,9 +3417,9 @@ def duplicates_select(cnx):
     r = cnx.execute("SELECT COUNT(*) FROM filelist WHERE has_duplicate = True")
     nb = r.fetchone()[0]
 
-    # Size of all files that are duplicated
+    # Size of all files that are duplicated (the hardlinks of a file are counted once)
     # ---
-    r = cnx.execute("SELECT SUM(size) FROM filelist WHERE has_duplicate = True")
+    r = cnx.execute("SELECT SUM(size) FROM filelist WHERE has_duplicate = True AND fid = link_id")
     size = r.fetchone()[0] 
 
     return nb, size
@@ -898,6 +3436,8 @@ def duplicates_select(cnx):
 
 def main():
 
+    global cnx, last_step, last_id
+
     # Colorama init
 
     init()
@@ -913,6 +3453,10 @@ def main():
     else:
         restart = False
 
+    # 'rescan' refreshes a completed scan (see directories_rescan)
+
+    rescan = ("rescan" in arguments)
+
     #
     # ---> Catch the exit signal to commit the database with last checkpoint
     #
@@ -928,6 +3472,15 @@ def main():
 
     #print(basepath)
     print("Default blocksize for this system is {} bytes.".format(io.DEFAULT_BUFFER_SIZE))
+    print("Database performance profile: {}".format(utils.db_profile))
+
+    try:
+        hashalgo.new(algo)
+    except ValueError as ve:
+        print(ve)
+        return
+
+    print("Hash algo: {}".format(algo))
 
     #
     # ---> DB connection
@@ -935,6 +3488,23 @@ def main():
 
     cnx = db_connect(db, restart)
 
+    if (utils.hash_cache):
+        hashcache.attach(cnx)
+
+    # All the hashes of a database are made with the same algo (the one used when it was created)
+
+    res = cnx.execute("SELECT value FROM params WHERE key='hash_algo'").fetchone()
+
+    if (res == None):
+        cnx.execute("INSERT INTO params VALUES ('hash_algo',?)", ("md5",))
+        cnx.commit()
+        res = ("md5",)
+
+    if (res[0] != algo):
+        print("The database has been built with {}, not {}: use 'restart' to change the hash algo.".format(res[0], algo))
+        cnx.close()
+        return
+
     last_step, last_id = get_status(cnx)
     print("Last step: {}, last ID: {}".format(last_step, last_id))
     next_step = False
@@ -942,26 +3512,51 @@ def main():
     # Looking for files
     # ---
 
-    if (last_step == None) | ((last_step == "directory_lookup") & (last_id == "in progress")):
+    if (last_step == None) | ((last_step == "directory_lookup") & (last_id != "all")):
 
         t, nb = directories_lookup(cnx, basepath)
         print("Files lookup duration: {:.2f} sec for {} files.".format(t, nb))
         next_step = True
 
+    elif (rescan & (last_step in SCAN_COMPLETED)) | (last_step == "directory_rescan"):
+
+        t, nb = directories_rescan(cnx, basepath)
+        print("Files rescan duration: {:.2f} sec, {} new, {} changed and {} deleted files.".format(t, *nb))
+        next_step = True
+
     else:
 
         print("Files lookup already done.")
 
+        if (rescan):
+            print("The previous scan is not completed: it's resumed, the rescan will be possible after.")
+
+
+    # Grouping by size (no file access)
+    # ---
+
+    if (next_step | 
+        ((last_step == "directory_lookup") & (last_id == "all"))):
+
+        t, nb = size_grouping(cnx)
+        print("Size grouping duration: {:.2f} sec, {} duplicate candidates.".format(t, nb))
+        next_step = True
+
+    else:
+
+        print("Size grouping already done.")
+
 
     # Calculating pre hash (quick hash on first bytes)
     # ---
 
     if (next_step | 
-        ((last_step == "directory_lookup") & (last_id == "all"))|
+        ((last_step == "size_grouping") & (last_id == "all"))|
         ((last_step == "filelist_pre_hash") & (last_id != "all"))):
 
-        t = filelist_pre_hash(cnx, 'md5')
-        print("Pre-hash calculation duration: {:.2f} sec.                  ".format(t))
+        waited = fileio.throttle.waited
+        t = filelist_pre_hash(cnx, algo)
+        print("Pre-hash calculation duration: {:.2f} sec.{}                  ".format(t, fileio.throttled(waited)))
         next_step = True
 
     else:
@@ -972,20 +3567,37 @@ def main():
     # Calculate size of all files
     # ---
 
-    res = cnx.execute("select sum(size) FROM filelist")
+    res = cnx.execute("select sum(size) FROM filelist WHERE fid = link_id")
     size = res.fetchone()[0]
 
     print("Size of all files: {}".format(utils.humanbytes(size)))
 
-    # Recomputing hashes for duplicates candidates
+    # Intermediate hash stages (tail, samples...) for duplicates candidates
     # ---
 
     if (next_step | 
         ((last_step == "filelist_pre_hash") & (last_id == "all")) |
+        ((last_step == "progressive_rehash") & (last_id != "all"))):
+
+        waited = fileio.throttle.waited
+        t, nb = progressive_rehash(cnx, algo)
+        print("Intermediate hash stages duration: {:.2f} sec. for {} files ({}).{}".format(t, nb, ", ".join(utils.hash_stages) or "none", fileio.throttled(waited)))
+        next_step = True
+
+    else:
+
+        print("Intermediate hash stages already done.")
+
+    # Recomputing hashes for duplicates candidates
+    # ---
+
+    if (next_step | 
+        ((last_step == "progressive_rehash") & (last_id == "all")) |
         ((last_step == "pre_duplicates_rehash") & (last_id != "all"))):
 
-        t, nb = pre_duplicates_rehash(cnx)
-        print("Pre-duplicates rehashing duration: {:.2f} sec. for {} records.".format(t, nb))
+        waited = fileio.throttle.waited
+        t, nb = pre_duplicates_rehash(cnx, algo)
+        print("Pre-duplicates rehashing duration: {:.2f} sec. for {} records.{}".format(t, nb, fileio.throttled(waited)))
         next_step = True
 
     else:
@@ -1008,9 +3620,12 @@ def main():
     print("{} files have duplicates, total size of duplicate files is {}.".format(nb_dup, utils.humanbytes(size_dup)))
 
 
-    # Closing database
+    # Closing database (and keeping the hash cache under its max size)
     # ---
 
+    if (utils.hash_cache):
+        hashcache.evict(cnx)
+
     cnx.close()
 
     return
@@ -0,0 +1,514 @@
+import os, errno
+import mmap
+import json
+import time
+import threading
+
+import utils
+
+#
+#  File reading for the full hashes and the comparisons
+#
+#  Reading terabytes of data fills the page cache with pages that will never be read again, and evicts
+#  the pages of the other programs running on the same server. The reading mode (read_cache in utils.py)
+#  limits that:
+#
+#    - "normal": plain reads, the kernel decides
+#    - "dontneed": sequential readahead is asked (POSIX_FADV_SEQUENTIAL, WILLNEED on the next chunk), and
+#      the pages already read are dropped from the cache (POSIX_FADV_DONTNEED)
+#    - "direct": O_DIRECT reads, the page cache is not used at all. The buffer and the reads are aligned on
+#      the page size. If the filesystem doesn't support it, "dontneed" is used instead.
+#
+#  Note: posix_fadvise and O_DIRECT don't exist on Windows, where the reads are always "normal".
+#
+
+ALIGNMENT = mmap.PAGESIZE
+
+#
+#  Throttling of the reads
+#
+#  All the hash readers share a budget of bytes and opened files per second (throttle_mbps and throttle_opens
+#  in utils.py, 0 means no limit), enforced by two token buckets. The limits can be changed while dup.py is
+#  running, by writing "<MB/s>;<opens/s>" in the throttle file (throttle_file in utils.py), for instance
+#  "200;2000", or "0;0" to remove the limits. The file is checked every second.
+#
+#  Note: with hash_pool = "process", each worker process has its own buckets, with an equal share of the limits.
+#
+
+THROTTLE_CHECK_DELAY = 1
+
+#
+#  Read buffers
+#
+#  The full hash reads the files with readinto() in a buffer allocated once per thread and reused for all the
+#  files (no allocation, no copy), or maps the big files in memory (read_mmap_min_size in utils.py). The size
+#  of the reads is read_buffer_size, unless bench.py found a better one for the device (see buffer_size).
+#
+
+BUFFER_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]
+
+buffers = threading.local()
+bench_sizes = None
+
+
+#    -------------------------------
+#
+#     Token buckets
+#
+#    -------------------------------
+
+class Throttle:
+
+    """
+        Token buckets limiting the number of bytes read and files opened per second, shared by all the threads.
+        A request bigger than the bucket is accepted, but the next ones wait until the debt is paid.
+    """
+
+    def __init__(self):
+
+        #
+        # Init function. The limits are read from utils.py (and then from the throttle file, if any).
+        #
+
+        self.lock = threading.Lock()
+
+        # Share of the limits for this process (see throttle_share)
+        self.share = 1
+
+        # Limits (per second, 0 = no limit), and available tokens of each bucket
+        self.rates = {"bytes": utils.throttle_mbps * 1024 * 1024, "opens": utils.throttle_opens}
+        self.tokens = dict(self.rates)
+        self.t = time.monotonic()
+
+        # Throttle file: last check and last modification time seen
+        self.checked = 0
+        self.file_mtime = None
+
+        # Total time spent waiting by the readers
+        self.waited = 0.0
+
+
+    def acquire(self, nbytes = 0, opens = 0):
+
+        # Takes the tokens for nbytes bytes and 'opens' opened files, waiting if the budget is exhausted
+
+        with self.lock:
+
+            now = time.monotonic()
+
+            if (now - self.checked >= THROTTLE_CHECK_DELAY):
+                self.checked = now
+                self.reload()
+
+            wait = 0
+
+            for bucket, n in (("bytes", nbytes), ("opens", opens)):
+
+                rate = self.rates[bucket] / self.share
+
+                if (rate <= 0):
+                    continue
+
+                # Refill (at most one second of budget), then take the tokens, even if it makes a debt
+
+                self.tokens[bucket] = min(rate, self.tokens[bucket] + (now - self.t) * rate) - n
+
+                if (self.tokens[bucket] < 0):
+                    wait = max(wait, -self.tokens[bucket] / rate)
+
+            self.t = now
+            self.waited = self.waited + wait
+
+        if (wait > 0):
+            time.sleep(wait)
+
+
+    def reload(self):
+
+        # Reads the new limits in the throttle file, if it changed since the last check
+
+        try:
+            mtime = os.stat(utils.throttle_file).st_mtime_ns
+        except OSError:
+            return
+
+        if (mtime == self.file_mtime):
+            return
+
+        self.file_mtime = mtime
+
+        try:
+            with open(utils.throttle_file) as f:
+                mbps, opens = f.read().strip().split(";")
+            rates = {"bytes": float(mbps) * 1024 * 1024, "opens": float(opens)}
+        except (OSError, ValueError):
+            print("Invalid throttle file {} (expected: <MB/s>;<opens/s>)".format(utils.throttle_file))
+            return
+
+        if (rates != self.rates):
+            self.rates = rates
+            self.tokens = dict(rates)
+
+
+throttle = Throttle()
+
+
+def throttle_share(workers):
+
+    """
+
+        Gives this process an equal share of the throttle limits (initializer of the worker processes).
+
+        Args:
+            workers (int): Number of worker processes sharing the limits
+
+    """
+
+    throttle.share = max(workers, 1)
+
+
+def throttled(since = 0.0):
+
+    """
+
+        Returns the time spent waiting by the readers of this process, since a previous value of throttle.waited,
+        as a text to add to the duration of a step ("" if they never waited).
+
+        Args:
+            since (float): (Optional) Value of throttle.waited at the beginning of the step
+
+        Returns:
+            text (text): " (throttled: x sec.)", or ""
+
+    """
+
+    waited = throttle.waited - since
+
+    if (waited <= 0):
+        return ""
+
+    return " (throttled: {:.2f} sec.)".format(waited)
+
+
+
+#    -------------------------------
+#
+#     Read buffers
+#
+#    -------------------------------
+
+def buffer_size(dev):
+
+    """
+
+        Returns the size of the reads for a device: the best size found by bench.py (in bench_name, see
+        utils.py) if the device has been benchmarked, read_buffer_size otherwise.
+
+        Args:
+            dev (int): Device ID (st_dev)
+
+        Returns:
+            size (int): Number of bytes read at once
+
+    """
+
+    global bench_sizes
+
+    if (bench_sizes == None):
+
+        bench_sizes = {}
+
+        try:
+            with open(utils.bench_name) as f:
+                results = json.load(f).get("buffer_size", {})
+        except (OSError, ValueError):
+            results = {}
+
+        # The benchmark is saved by path: the device IDs can change from one boot to another
+
+        for path, result in results.items():
+            try:
+                bench_sizes[os.stat(path).st_dev] = result["best"]
+            except (OSError, KeyError):
+                pass
+
+    return bench_sizes.get(dev, utils.read_buffer_size)
+
+
+def thread_buffer(size):
+
+    """
+
+        Returns the read buffer of the calling thread, allocated once and reused for all the files.
+
+        Args:
+            size (int): Size of the buffer
+
+        Returns:
+            buffer (memoryview): A view on the buffer, of the requested size
+
+    """
+
+    if (getattr(buffers, "data", None) == None) or (len(buffers.data) < size):
+        buffers.data = bytearray(size)
+
+    return memoryview(buffers.data)[:size]
+
+
+
+#    -------------------------------
+#
+#     File reader
+#
+#    -------------------------------
+
+class FileReader:
+
+    """
+        Reads a file sequentially, chunk by chunk, with the page cache policy set in utils.py (read_cache), and
+        within the throttle limits. Can be used as a context manager, like a file object.
+    """
+
+    def __init__(self, filename, mode = None):
+
+        #
+        # Init function. Opens the file (OSError is raised, like open()).
+        #
+
+        if (mode == None):
+            mode = utils.read_cache
+
+        throttle.acquire(opens = 1)
+
+        self.fd = None
+        self.file = None
+        self.direct = False
+        self.offset = 0
+
+        # Aligned buffer (O_DIRECT only), and what has been read in it but not returned yet
+
+        self.buffer = None
+        self.pending = b""
+
+        if (mode == "direct") and hasattr(os, "O_DIRECT"):
+
+            try:
+                self.fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+                self.direct = True
+            except OSError as ose:
+                if (ose.errno != errno.EINVAL):
+                    raise
+                mode = "dontneed"
+
+        if (self.fd == None):
+            self.fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+        # Unbuffered file object on the descriptor, for readinto() (no copy, available everywhere)
+
+        self.file = open(self.fd, "rb", buffering = 0, closefd = False)
+
+        self.mode = mode
+        self.stat = os.fstat(self.fd)
+
+        self.advise = (mode in ("dontneed", "direct")) and not(self.direct) and hasattr(os, "posix_fadvise")
+
+        if (self.advise):
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+    def read(self, size):
+
+        # Returns the next 'size' bytes of the file (less at the end of the file, b"" after the end)
+
+        throttle.acquire(nbytes = size)
+
+        if (self.direct):
+            return self.read_direct(size)
+
+        if (self.advise):
+            os.posix_fadvise(self.fd, self.offset + size, size, os.POSIX_FADV_WILLNEED)
+
+        data = os.read(self.fd, size)
+
+        if (self.advise) and data:
+            os.posix_fadvise(self.fd, self.offset, len(data), os.POSIX_FADV_DONTNEED)
+
+        self.offset = self.offset + len(data)
+
+        return data
+
+
+    def read_direct(self, size):
+
+        # O_DIRECT: the reads are made in an aligned buffer, with an aligned size. What is read beyond
+        # 'size' is kept for the next call.
+
+        while (len(self.pending) < size):
+
+            length = -(-(size - len(self.pending)) // ALIGNMENT) * ALIGNMENT
+
+            if (self.buffer == None) or (len(self.buffer) < length):
+                if (self.buffer != None):
+                    self.buffer.close()
+                self.buffer = mmap.mmap(-1, length)
+
+            n = self.readinto(memoryview(self.buffer)[:length])
+
+            if (n == 0):
+                break
+
+            self.pending = self.pending + self.buffer[:n]
+
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.offset = self.offset + len(data)
+
+        return data
+
+
+    def readinto(self, buffer):
+
+        # Reads in 'buffer' (no copy), returns the number of bytes read. With O_DIRECT, readv() (Unix only,
+        # like O_DIRECT) reads exactly in the aligned buffer; readinto() otherwise, which also works on Windows.
+
+        if (self.direct) and hasattr(os, "readv"):
+            return os.readv(self.fd, [buffer])
+
+        return self.file.readinto(buffer)
+
+
+    def seek(self, offset):
+
+        # Moves to 'offset' (a multiple of ALIGNMENT with O_DIRECT)
+
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.offset = offset
+        self.pending = b""
+
+
+    def update(self, hl, size = None, limit = None):
+
+        # Feeds the rest of the file to a hash object (hl.update), by reads of 'size' bytes (by default, the
+        # best size for the device, see buffer_size), up to 'limit' bytes. No data is copied: the reads go to a
+        # reused buffer (or the file is mapped in memory, see read_mmap_min_size). Returns the number of bytes.
+
+        if (size == None):
+            size = buffer_size(self.stat.st_dev)
+
+        if (limit == None):
+            limit = self.stat.st_size
+
+        total = 0
+
+        # What read() already got from the file, but didn't return (O_DIRECT only)
+
+        if (self.pending):
+            total = min(len(self.pending), limit)
+            hl.update(self.pending[:total])
+            self.pending = self.pending[total:]
+            self.offset = self.offset + total
+
+        if (self.mode == "normal") and (utils.read_mmap_min_size > 0) and (self.stat.st_size >= utils.read_mmap_min_size) and (self.offset == 0):
+
+            # Mapped in memory: the pages are read by the kernel, with a sequential readahead
+
+            with mmap.mmap(self.fd, 0, access = mmap.ACCESS_READ) as m:
+
+                if hasattr(m, "madvise"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+
+                with memoryview(m) as view:
+
+                    while (total < min(limit, len(m))):
+                        n = min(size, limit - total)
+                        throttle.acquire(nbytes = n)
+                        with view[total:total + n] as chunk:
+                            hl.update(chunk)
+                        total = total + n
+
+            self.offset = total
+
+            return total
+
+        if (self.direct):
+
+            # O_DIRECT: aligned buffer and aligned reads
+
+            size = -(-size // ALIGNMENT) * ALIGNMENT
+
+            if (self.buffer == None) or (len(self.buffer) < size):
+                if (self.buffer != None):
+                    self.buffer.close()
+                self.buffer = mmap.mmap(-1, size)
+
+            buffer = memoryview(self.buffer)[:size]
+
+        else:
+
+            buffer = thread_buffer(size)
+
+        try:
+
+            while (total < limit):
+
+                throttle.acquire(nbytes = size)
+
+                if (self.advise):
+                    os.posix_fadvise(self.fd, self.offset + size, size, os.POSIX_FADV_WILLNEED)
+
+                n = self.readinto(buffer)
+
+                if (n == 0):
+                    break
+
+                n = min(n, limit - total)
+
+                with buffer[:n] as chunk:
+                    hl.update(chunk)
+
+                if (self.advise):
+                    os.posix_fadvise(self.fd, self.offset, n, os.POSIX_FADV_DONTNEED)
+
+                self.offset = self.offset + n
+                total = total + n
+
+        finally:
+
+            buffer.release()
+
+        return total
+
+
+    def close(self):
+
+        # Closes the file
+
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+
+        if (self.fd != None):
+            os.close(self.fd)
+            self.fd = None
+
+        if (self.buffer != None):
+            self.buffer.close()
+            self.buffer = None
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+
+#
+# Hey, doc: we're in a module!
+#
+if (__name__ == '__main__'):
+    print('Module => Do not execute')
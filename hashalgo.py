@@ -0,0 +1,173 @@
+import hashlib
+import zlib
+
+#
+#  Hash backends
+#
+#  All the hashes used by dup.py are created by new(name), whatever the library behind them. They all work like
+#  the hashlib objects: update(data) as many times as needed, then digest() or hexdigest(). The names are:
+#
+#    - the hashlib algos ("md5", "sha1", "sha256", "blake2b"...)
+#    - "blake2b-<n>" and "blake2s-<n>": blake2 with a digest of n bytes (for instance "blake2b-16")
+#    - "crc32" and "adler32" (zlib), streamed like the others
+#    - "xxh64", "xxh3_64", "xxh3_128" (if the 'xxhash' package is installed) and "blake3" (if the 'blake3'
+#      package is installed)
+#
+#  The 'shake' hashes have a variable length: we keep 128 and 256 bytes for shake_128 and shake_256.
+#
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+SHAKE_LENGTHS = {"shake_128": 128, "shake_256": 256}
+
+
+#    -------------------------------
+#
+#     Wrappers
+#
+#    -------------------------------
+
+class Checksum:
+
+    """
+        Streaming zlib checksum (crc32 or adler32), with the interface of the hashlib objects.
+    """
+
+    def __init__(self, func, value, data = b""):
+
+        #
+        # Init function. func is zlib.crc32 or zlib.adler32, value the initial value of the checksum.
+        #
+
+        self.func = func
+        self.value = value
+
+        if data:
+            self.update(data)
+
+
+    def update(self, data):
+
+        self.value = self.func(data, self.value)
+
+
+    def digest(self):
+
+        return self.value.to_bytes(4, "big")
+
+
+    def hexdigest(self):
+
+        return "{:08x}".format(self.value)
+
+
+class FixedLength:
+
+    """
+        Variable length hash (shake) with a fixed length, with the interface of the other hashlib objects.
+    """
+
+    def __init__(self, hl, length):
+
+        self.hl = hl
+        self.length = length
+
+
+    def update(self, data):
+
+        self.hl.update(data)
+
+
+    def digest(self):
+
+        return self.hl.digest(self.length)
+
+
+    def hexdigest(self):
+
+        return self.hl.hexdigest(self.length)
+
+
+
+#    -------------------------------
+#
+#     Registry
+#
+#    -------------------------------
+
+def new(name, data = b""):
+
+    """
+
+        Creates a hash object.
+
+        Args:
+            name (text): Name of the hash algo (see above)
+            data (bytes): (Optional) First data to hash
+
+        Returns:
+            hl: The hash object (update, digest and hexdigest methods)
+
+    """
+
+    if (name == "crc32"):
+        return Checksum(zlib.crc32, 0, data)
+
+    if (name == "adler32"):
+        return Checksum(zlib.adler32, 1, data)
+
+    if (name in SHAKE_LENGTHS):
+        return FixedLength(hashlib.new(name, data), SHAKE_LENGTHS[name])
+
+    if name.startswith(("blake2b-", "blake2s-")):
+        algo, size = name.split("-")
+        return getattr(hashlib, algo)(data, digest_size = int(size))
+
+    if name.startswith("xx") and (xxhash != None) and hasattr(xxhash, name):
+        return getattr(xxhash, name)(data)
+
+    if (name == "blake3") and (blake3 != None):
+        return blake3.blake3(data)
+
+    if (name in hashlib.algorithms_available):
+        return hashlib.new(name, data)
+
+    raise ValueError("Unknown hash algo: {} (available: {})".format(name, ", ".join(available())))
+
+
+def available():
+
+    """
+
+        Returns the names of the hash algos available here (the optional packages must be installed).
+
+        Returns:
+            names (list): Names of the hash algos
+
+    """
+
+    names = sorted(hashlib.algorithms_guaranteed) + ["blake2b-16", "blake2s-16", "crc32", "adler32"]
+
+    if (xxhash != None):
+        names = names + ["xxh64", "xxh3_64", "xxh3_128"]
+
+    if (blake3 != None):
+        names = names + ["blake3"]
+
+    return names
+
+
+
+#
+# Hey, doc: we're in a module!
+#
+if (__name__ == '__main__'):
+    print('Module => Do not execute')
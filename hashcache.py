@@ -0,0 +1,213 @@
+import time
+
+import utils
+
+#
+#  Persistent hash cache
+#
+#  The hashes are stored in a separate sqlite3 file (cache_name in utils.py), which survives the
+#  'restart' of dup.py (the main database is dropped, not the cache). An entry is keyed by the
+#  identity of the file content: (device, inode, size, mtime_ns), plus the kind of hash (pre-hash,
+#  stage, full) and the algo. If a file is modified, its size or its mtime changes, and the old
+#  entry is simply never used again (until it's evicted).
+#
+#  The cache is attached to the main connection, so loading and storing are single SQL queries.
+#
+#  Note: on Windows, the inode and device are not given by the directory listing (they are 0), so
+#  the cache is not used there.
+#
+
+SCHEMA = "hashcache"
+
+# Version of the cache layout (1: binary hashes)
+
+CACHE_VERSION = 1
+
+
+#
+#    ====================================================================
+#     Attaching the cache to the main database
+#    ====================================================================
+#
+
+def attach(cnx, cache_name = None):
+
+    """
+
+        Attaches the cache database to the connection, and creates the table if needed.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object (main database)
+            cache_name (text): (Optional) Name of the file used for the cache (cache_name by default)
+
+    """
+
+    if (cache_name == None):
+        cache_name = utils.cache_name
+
+    cnx.execute("ATTACH DATABASE ? AS {}".format(SCHEMA), (cache_name,))
+
+    settings = utils.DB_PROFILES[utils.db_profile]
+
+    for pragma in ("journal_mode", "synchronous"):
+        if (pragma in settings):
+            cnx.execute("PRAGMA {}.{} = {}".format(SCHEMA, pragma, settings[pragma]))
+
+    cnx.execute("CREATE TABLE IF NOT EXISTS {}.hashes (\
+                    dev BIGINT, \
+                    inode BIGINT, \
+                    size BIGINT, \
+                    mtime_ns BIGINT, \
+                    kind TINYTEXT, \
+                    algo TINYTEXT, \
+                    digest BLOB, \
+                    last_used BIGINT) \
+                ".format(SCHEMA))
+
+    cnx.execute("CREATE UNIQUE INDEX IF NOT EXISTS {}.index_key ON hashes (dev, inode, size, mtime_ns, kind, algo)".format(SCHEMA))
+    cnx.execute("CREATE INDEX IF NOT EXISTS {}.index_last_used ON hashes (last_used)".format(SCHEMA))
+
+    # The hashes were stored as text by the previous versions (user_version 0): they are converted once
+
+    if (cnx.execute("PRAGMA {}.user_version".format(SCHEMA)).fetchone()[0] < CACHE_VERSION):
+        cnx.execute("UPDATE {}.hashes SET digest = digest_blob(digest) WHERE typeof(digest) = 'text'".format(SCHEMA))
+        cnx.execute("PRAGMA {}.user_version = {}".format(SCHEMA, CACHE_VERSION))
+
+    cnx.commit()
+
+
+#
+#    ====================================================================
+#     Loading hashes from the cache (before any file access)
+#    ====================================================================
+#
+
+def load(cnx, column, kind, algo, where):
+
+    """
+
+        Fills the hash column of the files known by the cache (same device, inode, size and mtime), for the
+        files that don't have it yet.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object (with the cache attached)
+            column (text): Column of filelist to fill
+            kind (text): Kind of hash (for instance "pre:8192", "tail:65536" or "full")
+            algo (text): Name of the hash algo
+            where (text): SQL condition selecting the files in filelist
+
+        Returns:
+            nb (int): The number of hashes found in the cache
+
+    """
+
+    match = "FROM {}.hashes h WHERE h.dev = filelist.dev AND h.inode = filelist.inode AND h.size = filelist.size \
+                AND h.mtime_ns = filelist.mtime_ns AND h.kind = ? AND h.algo = ?".format(SCHEMA)
+
+    r = cnx.execute("UPDATE filelist SET {} = (SELECT h.digest {}) \
+                        WHERE {} IS NULL AND inode != 0 AND {} AND EXISTS (SELECT 1 {})".format(column, match, column, where, match),
+                        (kind, algo, kind, algo))
+
+    nb = r.rowcount
+    cnx.commit()
+
+    return nb
+
+
+def find(cnx, kind, algo, fid):
+
+    """
+
+        Returns the hash of one file from the cache (same device, inode, size and mtime), without writing it.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object (with the cache attached)
+            kind (text): Kind of hash (for instance "pre:8192", "tail:65536" or "full")
+            algo (text): Name of the hash algo
+            fid (int): The file ID (in filelist)
+
+        Returns:
+            digest (text): The hash, or None if the file is not in the cache
+
+    """
+
+    r = cnx.execute("SELECT h.digest FROM filelist f, {}.hashes h WHERE f.fid = ? AND f.inode != 0 AND h.dev = f.dev \
+                        AND h.inode = f.inode AND h.size = f.size AND h.mtime_ns = f.mtime_ns AND h.kind = ? AND h.algo = ?"
+                        .format(SCHEMA), (fid, kind, algo)).fetchone()
+
+    return r[0] if (r != None) else None
+
+
+#
+#    ====================================================================
+#     Storing hashes in the cache (after the computation)
+#    ====================================================================
+#
+
+def store(cnx, column, kind, algo, where):
+
+    """
+
+        Stores the hashes of the files in the cache. The hashes loaded from the cache are stored again, to
+        refresh their 'last_used' time (used for the eviction).
+
+        Args:
+            cnx (sqlite3.Connection): Connection object (with the cache attached)
+            column (text): Column of filelist to store
+            kind (text): Kind of hash (for instance "pre:8192", "tail:65536" or "full")
+            algo (text): Name of the hash algo
+            where (text): SQL condition selecting the files in filelist
+
+    """
+
+    cnx.execute("INSERT OR REPLACE INTO {}.hashes (dev, inode, size, mtime_ns, kind, algo, digest, last_used) \
+                    SELECT dev, inode, size, mtime_ns, ?, ?, {}, ? FROM filelist WHERE {} NOT NULL AND inode != 0 AND {}"
+                    .format(SCHEMA, column, column, where), (kind, algo, int(time.time())))
+
+    cnx.commit()
+
+
+#
+#    ====================================================================
+#     Size-bounded eviction
+#    ====================================================================
+#
+
+def evict(cnx, max_entries = None):
+
+    """
+
+        Keeps the cache under max_entries entries, by deleting the least recently used ones.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object (with the cache attached)
+            max_entries (int): (Optional) Max number of entries (cache_max_entries by default)
+
+        Returns:
+            nb (int): The number of evicted entries
+
+    """
+
+    if (max_entries == None):
+        max_entries = utils.cache_max_entries
+
+    nb_entries = cnx.execute("SELECT COUNT(*) FROM {}.hashes".format(SCHEMA)).fetchone()[0]
+
+    nb = 0
+
+    if (nb_entries > max_entries):
+
+        r = cnx.execute("DELETE FROM {0}.hashes WHERE rowid IN \
+                            (SELECT rowid FROM {0}.hashes ORDER BY last_used LIMIT ?)".format(SCHEMA), (nb_entries - max_entries,))
+        nb = r.rowcount
+        cnx.commit()
+
+    return nb
+
+
+
+#
+# Hey, doc: we're in a module!
+#
+if (__name__ == '__main__'):
+    print('Module => Do not execute')
@@ -1,4 +1,6 @@
+import os
 import time
+import sqlite3
 
 #
 #  Global constants
@@ -6,9 +8,107 @@ import time
 
 db_name       = "walk.db"
 filelist_name = "filelist.txt"
-hash_algo     = "md5"
+hash_algo     = "md5"         # see hashalgo.py for the available algos, and "python bench.py algo"
 trash_dir     = "G:\\trash"
 
+# Hashing workers: number of files hashed concurrently, and kind of pool ("thread" or "process")
+
+hash_workers  = 8
+hash_pool     = "thread"
+
+# Order of the reads of the hashing steps: "fid" (order of the lookup), "inode" (inode number, a good guess
+# of the position on disk) or "extent" (physical position given by the filesystem, Linux only). On
+# spinning disks, reading in disk order avoids most of the seeks.
+
+io_order      = "inode"
+
+# Tree hash of the very big files (0 means never): the files of at least tree_hash_min_size bytes are hashed
+# by segments of tree_segment_size bytes (a multiple of 4 KB), tree_workers segments at a time, and the
+# hashes of the segments are combined in a Merkle tree. Such a hash is never compared to a plain one.
+
+tree_hash_min_size = 0
+tree_segment_size  = 256 * 1024 * 1024
+tree_workers       = 4
+
+# Hashing workers of some devices, given by any path on the device (the others get hash_workers). Each device
+# has its own pool and queue: for instance 1 or 2 workers for a USB disk or a NAS mount, more for an SSD.
+# Example: device_workers = {"/mnt/usb": 1, "/data/raid": 2}
+
+device_workers = {}
+
+# Number of results written (and committed) at once in the database. The hashing steps also commit their
+# results db_commit_interval seconds after the first one, without waiting for the commit (see dbwriter)
+
+db_batch_size      = 1000
+db_commit_interval = 2
+
+# Intermediate hash stages, run in this order between the pre-hash (first bytes) and the full hash, only on
+# the files bigger than hash_stages_min_size: "tail" (last tail_hash_size bytes) and "sample" (sample_count
+# blocks of sample_block_size bytes spread in the file). Use [] to go straight to the full hash.
+
+hash_stages          = ["tail"]
+hash_stages_min_size = 1024 * 1024
+tail_hash_size       = 64 * 1024
+sample_count         = 8
+sample_block_size    = 64 * 1024
+
+# Verification of the duplicate candidates: "hash" (full hash of each file) or "compare" (files of a
+# group read together chunk by chunk, stopping as soon as they differ). In "compare" mode, groups
+# bigger than compare_max_open files are hashed.
+
+verify_mode        = "hash"
+compare_chunk_size = 1024 * 1024
+compare_max_open   = 64
+
+# Streaming pipeline: the files are hashed during the lookup, as soon as another file has the same size (then
+# the same pre-hash, and so on), instead of waiting for the end of the lookup. At most pipeline_max_keys files
+# wait for another one with the same size (or hashes), and twice as many sizes and hashes are kept in memory;
+# the lookup waits when more than pipeline_queue_size files are waiting for a worker. What the pipeline didn't
+# do is done by the next steps.
+
+pipeline            = False
+pipeline_max_keys   = 1000000
+pipeline_queue_size = 10000
+
+# Persistent hash cache (separate sqlite3 file, kept when dup.py is restarted): the hashes of the files
+# that didn't change (same device, inode, size and mtime) are not computed again. The least recently
+# used entries are evicted beyond cache_max_entries.
+
+hash_cache        = True
+cache_name        = "hashcache.db"
+cache_max_entries = 20000000
+
+# Incremental rescan ("dup.py rescan"): the directories whose mtime didn't change are not listed again.
+# Their files are still checked with a stat, unless rescan_trust_dir_mtime is True (quicker, but a file
+# modified in place, without being renamed or recreated, is not seen).
+
+rescan_trust_dir_mtime = False
+
+# Page cache policy of the full hash and comparison reads: "normal", "dontneed" (readahead, and the pages
+# already read are dropped from the cache) or "direct" (O_DIRECT, no page cache at all). Use "dontneed" or
+# "direct" on a server, so the scan doesn't evict the cache of the other programs.
+
+read_cache    = "normal"
+
+# Size of the reads of the full hash (1 to 16 MB is good for big files), unless bench.py found a better one
+# for the device (results saved in bench_name). The files bigger than read_mmap_min_size are mapped in memory
+# instead of being read (0 means never; only with read_cache = "normal").
+
+read_buffer_size   = 1024 * 1024
+read_mmap_min_size = 0
+bench_name         = "bench.json"
+
+# Read budget shared by all the hashing workers: MB read per second and files opened per second (0 means no
+# limit). The limits can be changed while dup.py is running, by writing "<MB/s>;<opens/s>" in throttle_file.
+
+throttle_mbps  = 0
+throttle_opens = 0
+throttle_file  = "throttle.txt"
+
+# SQLite performance profile applied by dup.py and clean.py (see DB_PROFILES below)
+
+db_profile    = "balanced"
+
 
 #    -------------------------------
 #
@@ -108,6 +208,197 @@ class Chrono:
 #
 #    -------------------------------
 
+#
+# SQLite performance profiles. Durability trade-offs (a checkpoint is always written in the same
+# transaction as the results it covers, so whatever is lost, a restart resumes from a consistent point):
+#
+#   - "safe":     WAL + synchronous FULL. Every commit survives a power loss.
+#   - "balanced": WAL + synchronous NORMAL. An application crash (CTRL+C, kill) loses nothing, a power
+#                 loss or an OS crash may roll back the last commits but never corrupts the database:
+#                 the restart just redoes the work done after the last durable checkpoint.
+#   - "fast":     WAL + synchronous OFF, big cache. An application crash loses nothing, but a power loss
+#                 or an OS crash may corrupt the database: then run "dup.py restart".
+#   - "default":  No pragma at all (SQLite defaults: rollback journal, synchronous FULL, small cache).
+#
+# WAL needs shared memory: don't use it for a database stored on a network share ("default" then).
+# page_size only applies to a new (or emptied) database. cache_size is in KiB when negative.
+#
+
+DB_PROFILES = {
+    "safe": {
+        "page_size":    4096,
+        "journal_mode": "WAL",
+        "synchronous":  "FULL",
+        "cache_size":   -65536,
+        "mmap_size":    0,
+        "temp_store":   "DEFAULT",
+    },
+    "balanced": {
+        "page_size":    8192,
+        "journal_mode": "WAL",
+        "synchronous":  "NORMAL",
+        "cache_size":   -262144,
+        "mmap_size":    268435456,
+        "temp_store":   "MEMORY",
+    },
+    "fast": {
+        "page_size":    16384,
+        "journal_mode": "WAL",
+        "synchronous":  "OFF",
+        "cache_size":   -1048576,
+        "mmap_size":    1073741824,
+        "temp_store":   "MEMORY",
+    },
+    "default": {},
+}
+
+
+#
+#    ====================================================================
+#     Database connection with the performance profile
+#    ====================================================================
+#
+
+def db_open(db, profile = None):
+
+    """
+
+        Connects to the sqlite3 database and applies the performance profile (db_profile by default).
+
+        Args:
+            db (text): Name of the file used for storing sqlite3 database
+            profile (text): (Optional) Name of the profile, in DB_PROFILES
+
+        Returns:
+            cnx (sqlite3.Connection): Connection object
+
+    """
+
+    if (profile == None):
+        profile = db_profile
+
+    cnx = sqlite3.connect(db)
+
+    # page_size must be set before the journal mode (it can't change in WAL mode)
+
+    for pragma, value in DB_PROFILES[profile].items():
+        cnx.execute("PRAGMA {} = {}".format(pragma, value))
+
+    # SQL functions of the database layout (see DirPaths and digest_blob)
+
+    cnx.create_function("dir_path", 1, DirPaths(cnx), deterministic = True)
+    cnx.create_function("digest_blob", 1, digest_blob, deterministic = True)
+
+    return cnx
+
+
+def db_page_size_check(cnx, profile = None):
+
+    """
+
+        Applies the page_size of the profile to an (empty) database, if it's not already the right one.
+        The page size of a database can't be changed in WAL mode, so we get out of WAL for the VACUUM.
+
+        Args:
+            cnx (sqlite3.Connection): Connection object
+            profile (text): (Optional) Name of the profile, in DB_PROFILES
+
+    """
+
+    if (profile == None):
+        profile = db_profile
+
+    settings = DB_PROFILES[profile]
+
+    if ("page_size" in settings):
+
+        page_size = cnx.execute("PRAGMA page_size").fetchone()[0]
+
+        if (page_size != settings["page_size"]):
+
+            cnx.commit()
+            cnx.execute("PRAGMA journal_mode = DELETE")
+            cnx.execute("PRAGMA page_size = {}".format(settings["page_size"]))
+            cnx.execute("VACUUM")
+            cnx.execute("PRAGMA journal_mode = {}".format(settings.get("journal_mode", "DELETE")))
+
+
+#
+#    ====================================================================
+#     Directory paths and digests (database layout)
+#    ====================================================================
+#
+
+class DirPaths:
+
+    """
+        Full paths of the directories. The database only stores the name of each directory and the ID of its
+        parent (table 'directories'), the paths are rebuilt here and kept in memory. Registered on each
+        connection as the SQL function dir_path(did) (see db_open).
+    """
+
+    def __init__(self, cnx):
+
+        #
+        # Init function. The directory IDs are never reused (AUTOINCREMENT), so a path never changes.
+        #
+
+        self.cnx = cnx
+        self.paths = {}
+
+
+    def __call__(self, did):
+
+        # Returns the path of a directory (None if it doesn't exist)
+
+        chain = []
+
+        while (did != None) and (did not in self.paths):
+
+            row = self.cnx.execute("SELECT parent_id, name FROM directories WHERE did = ?", (did,)).fetchone()
+
+            if (row == None):
+                return None
+
+            chain.append((did, row[1]))
+            did = row[0]
+
+        # A root directory has no parent, its name is its full path
+
+        path = self.paths[did] if (did != None) else None
+
+        for did, name in reversed(chain):
+            path = os.path.join(path, name) if (path != None) else name
+            self.paths[did] = path
+
+        return path
+
+
+def digest_blob(value):
+
+    """
+
+        Returns a hash as stored in the database (binary). The hashes stored as text (hexadecimal) by the
+        previous versions are converted (see db_migrate in dup.py, and the hash cache).
+
+        Args:
+            value: The hash, as text or binary
+
+        Returns:
+            value (bytes): The binary hash
+
+    """
+
+    if not(isinstance(value, str)):
+        return value
+
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return value.encode()
+
+
+
 #
 #    ====================================================================
 #     Set state of last (=current) step executed in the params table
@@ -135,7 +426,7 @@ def checkpoint_db(cnx, last_step, last_id = None, commit = False):
     cnx.execute("UPDATE params SET value=? WHERE key='last_step'", (last_step,))
     cnx.execute("UPDATE params SET value=? WHERE key='last_id'", (last_id,))
 
-    if last_step == "directory_lookup" and last_id != "in progress":
+    if last_step == "directory_lookup" and last_id not in ("in progress", "all"):
 
         # Here we are in the 1st step (file lookup). Here we store the completed directories
         cnx.execute("INSERT INTO params VALUES (?, ?)", ("completed_dir", last_id))